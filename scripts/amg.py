@@ -54,6 +54,16 @@ parser.add_argument(
 
 parser.add_argument("--device", type=str, default="cuda", help="The device to run generation on.")
 
+parser.add_argument(
+    "--model-cache-dir",
+    type=str,
+    default=None,
+    help=(
+        "If set, the model's weights are saved to and later memory-mapped from this "
+        "folder, which skips initialization and checkpoint loading on later runs."
+    ),
+)
+
 parser.add_argument(
     "--convert-to-rle",
     action="store_true",
@@ -138,6 +148,20 @@ amg_settings.add_argument(
     help="The number of points-per-side in each layer of crop is reduced by this factor.",
 )
 
+amg_settings.add_argument(
+    "--crops-per-batch",
+    type=int,
+    default=None,
+    help="How many image crops to embed simultaneously with the image encoder.",
+)
+
+amg_settings.add_argument(
+    "--precision",
+    type=str,
+    default=None,
+    help="The precision to run the image encoder and mask decoder at, in ['fp32', 'bf16'].",
+)
+
 amg_settings.add_argument(
     "--min-mask-region-area",
     type=int,
@@ -187,6 +211,8 @@ def get_amg_kwargs(args):
         "crop_overlap_ratio": args.crop_overlap_ratio,
         "crop_n_points_downscale_factor": args.crop_n_points_downscale_factor,
         "min_mask_region_area": args.min_mask_region_area,
+        "crops_per_batch": args.crops_per_batch,
+        "precision": args.precision,
     }
     amg_kwargs = {k: v for k, v in amg_kwargs.items() if v is not None}
     return amg_kwargs
@@ -194,7 +220,9 @@ def get_amg_kwargs(args):
 
 def main(args: argparse.Namespace) -> None:
     print("Loading model...")
-    sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
+    sam = sam_model_registry[args.model_type](
+        checkpoint=args.checkpoint, cache_dir=args.model_cache_dir
+    )
     _ = sam.to(device=args.device)
     output_mode = "coco_rle" if args.convert_to_rle else "binary_mask"
     amg_kwargs = get_amg_kwargs(args)
@@ -0,0 +1,114 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+from segment_anything.modeling import TwoWayTransformer
+
+import argparse
+import time
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Benchmarks the TwoWayTransformer of the SAM mask decoder with explicit attention "
+        "maps and with torch's fused scaled_dot_product_attention, at the prompt batch "
+        "sizes used for interactive and automatic mask generation. No checkpoint is "
+        "needed, the transformer is randomly initialized."
+    )
+)
+
+parser.add_argument(
+    "--batch-sizes",
+    type=int,
+    nargs="+",
+    default=[1, 16, 64],
+    help="The numbers of prompts per call to benchmark.",
+)
+
+parser.add_argument(
+    "--image-size",
+    type=int,
+    default=1024,
+    help="The model input size. The image embedding is image_size / 16 to a side.",
+)
+
+parser.add_argument(
+    "--num-points",
+    type=int,
+    default=1,
+    help="The number of point prompts per prompt, in addition to the 5 output tokens.",
+)
+
+parser.add_argument("--repeats", type=int, default=10, help="Timed runs per configuration.")
+
+parser.add_argument("--warmup", type=int, default=2, help="Untimed runs per configuration.")
+
+parser.add_argument("--threads", type=int, default=None, help="If set, torch.set_num_threads.")
+
+parser.add_argument("--device", type=str, default="cpu", help="The device to run on.")
+
+
+def time_transformer(
+    transformer: TwoWayTransformer, inputs: tuple, repeats: int, warmup: int
+) -> float:
+    for _ in range(warmup):
+        transformer(*inputs)
+    times = []
+    for _ in range(repeats):
+        if inputs[0].is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        transformer(*inputs)
+        if inputs[0].is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    grid_size = args.image_size // 16
+    print(
+        f"Decoder transformer, {grid_size}x{grid_size} image tokens, "
+        f"{args.num_points + 5} tokens per prompt, {torch.get_num_threads()} threads"
+    )
+
+    transformers = {}
+    for attn_impl in ["eager", "sdpa"]:
+        torch.manual_seed(0)
+        transformers[attn_impl] = (
+            TwoWayTransformer(
+                depth=2, embedding_dim=256, mlp_dim=2048, num_heads=8, attn_impl=attn_impl
+            )
+            .to(args.device)
+            .eval()
+        )
+
+    # One image embedding shared by all prompts, as in SamPredictor
+    image_embedding = torch.randn(1, 256, grid_size, grid_size, device=args.device)
+    image_pe = torch.randn(1, 256, grid_size, grid_size, device=args.device)
+    for batch_size in args.batch_sizes:
+        point_embedding = torch.randn(batch_size, args.num_points + 5, 256, device=args.device)
+        inputs = (image_embedding, image_pe, point_embedding)
+
+        outputs = {k: t(*inputs) for k, t in transformers.items()}
+        max_diff = max(
+            (a - b).abs().max().item() for a, b in zip(outputs["eager"], outputs["sdpa"])
+        )
+        eager_s = time_transformer(transformers["eager"], inputs, args.repeats, args.warmup)
+        sdpa_s = time_transformer(transformers["sdpa"], inputs, args.repeats, args.warmup)
+        print(
+            f"batch {batch_size}: eager {eager_s * 1000:.1f}ms, sdpa {sdpa_s * 1000:.1f}ms "
+            f"({(1 - sdpa_s / eager_s) * 100:.1f}% saved), max abs diff {max_diff:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with torch.no_grad():
+        main(args)
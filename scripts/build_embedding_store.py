@@ -0,0 +1,105 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import cv2  # type: ignore
+import torch
+
+from segment_anything import EmbeddingStore, SamPredictor, sam_model_registry
+from segment_anything.utils.amg import batch_iterator
+
+import argparse
+import os
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Computes SAM image embeddings for an image or folder of images and appends them "
+        "to a memory-mapped EmbeddingStore, keyed by file name without extension. Images "
+        "already in the store are skipped. Requires open-cv."
+    )
+)
+
+parser.add_argument(
+    "--input",
+    type=str,
+    required=True,
+    help="Path to either a single input image or folder of images.",
+)
+
+parser.add_argument(
+    "--output",
+    type=str,
+    required=True,
+    help="The folder of the embedding store. Created if it does not exist.",
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    required=True,
+    help="The type of model to load, in ['default', 'vit_h', 'vit_l', 'vit_b']",
+)
+
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    required=True,
+    help="The path to the SAM checkpoint to use for the image encoder.",
+)
+
+parser.add_argument("--device", type=str, default="cuda", help="The device to run on.")
+
+parser.add_argument(
+    "--dtype",
+    type=str,
+    default="float32",
+    help="The dtype of a new store, in ['float32', 'float16']. float16 halves its size.",
+)
+
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=1,
+    help="How many images to embed simultaneously with the image encoder.",
+)
+
+
+def main(args: argparse.Namespace) -> None:
+    print("Loading model...")
+    sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
+    _ = sam.to(device=args.device)
+    predictor = SamPredictor(sam)
+    store = EmbeddingStore(args.output, dtype=args.dtype)
+
+    if not os.path.isdir(args.input):
+        targets = [args.input]
+    else:
+        targets = [
+            f for f in os.listdir(args.input) if not os.path.isdir(os.path.join(args.input, f))
+        ]
+        targets = [os.path.join(args.input, f) for f in targets]
+    targets = [t for t in targets if os.path.splitext(os.path.basename(t))[0] not in store]
+
+    for (batch,) in batch_iterator(args.batch_size, targets):
+        images, image_ids = [], []
+        for t in batch:
+            print(f"Processing '{t}'...")
+            image = cv2.imread(t)
+            if image is None:
+                print(f"Could not load '{t}' as an image, skipping...")
+                continue
+            images.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            image_ids.append(os.path.splitext(os.path.basename(t))[0])
+
+        for image_id, embedding in zip(image_ids, predictor.encode_batch(images)):
+            store.add(image_id, embedding)
+        store.flush()
+    print(f"Done! The store holds {len(store)} embeddings.")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with torch.no_grad():
+        main(args)
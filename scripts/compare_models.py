@@ -0,0 +1,217 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import cv2  # type: ignore
+import torch
+
+from segment_anything import SamPredictor, sam_model_registry
+from segment_anything.utils.amg import build_point_grid
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Dict, List
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Compares a SAM model built with non-default options against the default "
+        "1024x1024 fp32 model. Reports image encoder latency and the IoU between "
+        "the masks predicted by both models for a grid of point prompts. Requires open-cv."
+    )
+)
+
+parser.add_argument(
+    "--input",
+    type=str,
+    required=True,
+    help="Path to either a single input image or folder of images.",
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    required=True,
+    help="The type of model to load, in ['default', 'vit_h', 'vit_l', 'vit_b']",
+)
+
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    required=True,
+    help="The path to the SAM checkpoint to use for both models.",
+)
+
+parser.add_argument("--device", type=str, default="cpu", help="The device to run on.")
+
+parser.add_argument(
+    "--output",
+    type=str,
+    default=None,
+    help="If set, the per-image results and the summary are also saved to this json file.",
+)
+
+parser.add_argument(
+    "--points-per-side",
+    type=int,
+    default=4,
+    help="Masks are compared for a grid of this many point prompts to a side.",
+)
+
+parser.add_argument(
+    "--repeats",
+    type=int,
+    default=3,
+    help="The number of timed image encoder runs per image. The median is reported.",
+)
+
+variant_settings = parser.add_argument_group("Variant Settings")
+
+variant_settings.add_argument(
+    "--image-size",
+    type=int,
+    default=1024,
+    help="The input size of the variant's image encoder.",
+)
+
+variant_settings.add_argument(
+    "--skip-padding-windows",
+    action="store_true",
+    help=(
+        "Skip the window attention and MLP of windows that only contain padding, in the "
+        "blocks before the first global attention block."
+    ),
+)
+
+variant_settings.add_argument(
+    "--quantize-encoder",
+    action="store_true",
+    help="Apply int8 dynamic quantization to the linear layers of the image encoder. CPU only.",
+)
+
+variant_settings.add_argument(
+    "--precision",
+    type=str,
+    default="fp32",
+    help="The precision to run the variant at, in ['fp32', 'bf16'].",
+)
+
+
+def get_variant_kwargs(args: argparse.Namespace) -> Dict[str, Any]:
+    variant_kwargs = {
+        "image_size": args.image_size,
+        "encoder_skip_padding_windows": args.skip_padding_windows,
+        "quantize_encoder": args.quantize_encoder,
+    }
+    return variant_kwargs
+
+
+def time_set_image(predictor: SamPredictor, image: np.ndarray, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predictor.set_image(image)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def predict_grid(predictor: SamPredictor, points: np.ndarray) -> List[np.ndarray]:
+    masks = []
+    for point in points:
+        point_masks, scores, _ = predictor.predict(
+            point_coords=point[None, :],
+            point_labels=np.array([1]),
+            multimask_output=True,
+        )
+        masks.append(point_masks[np.argmax(scores)])
+    return masks
+
+
+def mask_iou(mask_a: np.ndarray, mask_b: np.ndarray) -> float:
+    union = np.logical_or(mask_a, mask_b).sum()
+    if union == 0:
+        return 1.0
+    return float(np.logical_and(mask_a, mask_b).sum() / union)
+
+
+def main(args: argparse.Namespace) -> None:
+    print("Loading models...")
+    reference = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
+    variant = sam_model_registry[args.model_type](
+        checkpoint=args.checkpoint, **get_variant_kwargs(args)
+    )
+    predictors = {
+        "reference": SamPredictor(reference.to(device=args.device)),
+        "variant": SamPredictor(variant.to(device=args.device), precision=args.precision),
+    }
+
+    if not os.path.isdir(args.input):
+        targets = [args.input]
+    else:
+        targets = [
+            f for f in os.listdir(args.input) if not os.path.isdir(os.path.join(args.input, f))
+        ]
+        targets = [os.path.join(args.input, f) for f in targets]
+
+    results = []
+    for t in targets:
+        image = cv2.imread(t)
+        if image is None:
+            print(f"Could not load '{t}' as an image, skipping...")
+            continue
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        points = build_point_grid(args.points_per_side) * np.array(image.shape[:2])[None, ::-1]
+
+        encode_s = {}
+        masks = {}
+        for name, predictor in predictors.items():
+            encode_s[name] = time_set_image(predictor, image, args.repeats)
+            masks[name] = predict_grid(predictor, points)
+
+        ious = [mask_iou(a, b) for a, b in zip(masks["reference"], masks["variant"])]
+        result = {
+            "image": t,
+            "reference_encode_s": encode_s["reference"],
+            "variant_encode_s": encode_s["variant"],
+            "speedup": encode_s["reference"] / encode_s["variant"],
+            "mean_iou": float(np.mean(ious)),
+            "min_iou": float(np.min(ious)),
+        }
+        print(
+            f"{os.path.basename(t)}: encode {result['reference_encode_s']:.3f}s -> "
+            f"{result['variant_encode_s']:.3f}s ({result['speedup']:.2f}x), "
+            f"mask IoU mean {result['mean_iou']:.4f} min {result['min_iou']:.4f}"
+        )
+        results.append(result)
+
+    if len(results) == 0:
+        print("No images were processed.")
+        return
+
+    summary = {
+        "variant": {**get_variant_kwargs(args), "precision": args.precision},
+        "num_images": len(results),
+        "mean_speedup": float(np.mean([r["speedup"] for r in results])),
+        "mean_iou": float(np.mean([r["mean_iou"] for r in results])),
+        "min_iou": float(np.min([r["min_iou"] for r in results])),
+    }
+    print(
+        f"Summary over {summary['num_images']} images: mean speedup "
+        f"{summary['mean_speedup']:.2f}x, mean mask IoU {summary['mean_iou']:.4f}, "
+        f"min mask IoU {summary['min_iou']:.4f}"
+    )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"summary": summary, "images": results}, f, indent=2)
+    print("Done!")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with torch.no_grad():
+        main(args)
@@ -0,0 +1,54 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+from segment_anything import load_sam_state_dict
+from segment_anything.utils.checkpoint import load_safetensors, save_safetensors
+
+import argparse
+import os
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Converts a SAM checkpoint to the safetensors format. The converted file is "
+        "loaded by sam_model_registry without a copy, can be loaded partially by "
+        "component, and is shared through the page cache by processes on one host."
+    )
+)
+
+parser.add_argument(
+    "--checkpoint", type=str, required=True, help="The path to the SAM model checkpoint."
+)
+
+parser.add_argument(
+    "--output",
+    type=str,
+    default=None,
+    help="The file to write. Defaults to the checkpoint path with a .safetensors extension.",
+)
+
+
+def main(args: argparse.Namespace) -> None:
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.checkpoint)[0] + ".safetensors"
+    print(f"Loading checkpoint from {args.checkpoint}...")
+    state_dict = load_sam_state_dict(args.checkpoint)
+
+    print(f"Writing {len(state_dict)} tensors to {output}...")
+    save_safetensors(state_dict, output, metadata={"format": "pt"})
+
+    converted = load_safetensors(output)
+    assert converted.keys() == state_dict.keys()
+    for k, v in state_dict.items():
+        assert torch.equal(converted[k], v), f"Mismatch in {k} after conversion."
+    print("Done!")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,212 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import cv2  # type: ignore
+import torch
+
+from segment_anything import ImageEmbedding, SamPredictor, SamService, sam_model_registry
+from segment_anything.utils.amg import mask_to_rle_pytorch
+
+import argparse
+import asyncio
+import json
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Serves SAM over HTTP for interactive annotation, as a local stand-in for a "
+        "production front-end. Uses SamService, so concurrent requests are batched. "
+        "Endpoints: 'POST /encode' with an encoded image as the body returns an image id; "
+        "'POST /predict' with a json body of image_id, point_coords, point_labels, box and "
+        "multimask_output returns scores and masks as uncompressed COCO RLEs; 'GET /stats' "
+        "returns queue depths, batch sizes and latency percentiles. Requires open-cv."
+    )
+)
+
+parser.add_argument(
+    "--model-type",
+    type=str,
+    required=True,
+    help="The type of model to load, in ['default', 'vit_h', 'vit_l', 'vit_b']",
+)
+
+parser.add_argument(
+    "--checkpoint",
+    type=str,
+    required=True,
+    help="The path to the SAM checkpoint to use.",
+)
+
+parser.add_argument("--device", type=str, default="cuda", help="The device to run on.")
+
+parser.add_argument(
+    "--precision",
+    type=str,
+    default="fp32",
+    help="The precision to run the model at, in ['fp32', 'bf16'].",
+)
+
+parser.add_argument("--host", type=str, default="127.0.0.1", help="The address to listen on.")
+
+parser.add_argument("--port", type=int, default=8080, help="The port to listen on.")
+
+parser.add_argument(
+    "--max-encoder-batch",
+    type=int,
+    default=4,
+    help="The most images embedded in one batch of the image encoder.",
+)
+
+parser.add_argument(
+    "--max-decoder-batch",
+    type=int,
+    default=64,
+    help="The most prompts decoded in one batch of the mask decoder.",
+)
+
+parser.add_argument(
+    "--max-wait-ms",
+    type=float,
+    default=5.0,
+    help="How long a request may wait for others to join its batch, in milliseconds.",
+)
+
+parser.add_argument(
+    "--max-images",
+    type=int,
+    default=64,
+    help="How many image embeddings are kept. The least recently used are dropped.",
+)
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class Server:
+    def __init__(self, service: SamService, max_images: int) -> None:
+        self.service = service
+        self.max_images = max_images
+        self.embeddings: "OrderedDict[str, ImageEmbedding]" = OrderedDict()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            method, path, body = await read_request(reader)
+            status, payload = 200, await self.route(method, path, body)
+        except HttpError as e:
+            status, payload = e.status, {"error": str(e)}
+        except (AssertionError, ValueError, KeyError) as e:
+            status, payload = 400, {"error": repr(e)}
+        except Exception as e:
+            status, payload = 500, {"error": repr(e)}
+        data = json.dumps(payload).encode()
+        header = (
+            f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(header.encode() + data)
+        await writer.drain()
+        writer.close()
+
+    async def route(self, method: str, path: str, body: bytes) -> Dict[str, Any]:
+        if method == "POST" and path == "/encode":
+            return await self.encode(body)
+        if method == "POST" and path == "/predict":
+            return await self.predict(json.loads(body))
+        if method == "GET" and path == "/stats":
+            return self.service.stats()
+        raise HttpError(404, f"No endpoint {method} {path}.")
+
+    async def encode(self, body: bytes) -> Dict[str, Any]:
+        image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise HttpError(400, "The request body could not be decoded as an image.")
+        embedding = await self.service.encode(image, image_format="BGR")
+        image_id = uuid.uuid4().hex
+        self.embeddings[image_id] = embedding
+        while len(self.embeddings) > self.max_images:
+            self.embeddings.popitem(last=False)
+        return {"image_id": image_id, "original_size": list(embedding.original_size)}
+
+    async def predict(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        image_id = request["image_id"]
+        if image_id not in self.embeddings:
+            raise HttpError(404, f"Unknown image_id {image_id}, encode the image first.")
+        self.embeddings.move_to_end(image_id)
+        point_coords, point_labels, box = None, None, None
+        if request.get("point_coords") is not None:
+            point_coords = np.array(request["point_coords"], dtype=np.float64).reshape(-1, 2)
+            point_labels = np.array(request["point_labels"], dtype=np.int64).reshape(-1)
+        if request.get("box") is not None:
+            box = np.array(request["box"], dtype=np.float64).reshape(4)
+        masks, scores, _ = await self.service.predict(
+            self.embeddings[image_id],
+            point_coords=point_coords,
+            point_labels=point_labels,
+            box=box,
+            multimask_output=request.get("multimask_output", True),
+        )
+        rles = await asyncio.get_running_loop().run_in_executor(
+            None, mask_to_rle_pytorch, torch.from_numpy(masks)
+        )
+        return {"scores": scores.tolist(), "masks": rles}
+
+
+async def read_request(reader: asyncio.StreamReader) -> Tuple[str, str, bytes]:
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) != 3:
+        raise HttpError(400, "Malformed request line.")
+    method, path, _ = request_line
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in [b"\r\n", b"\n", b""]:
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, body
+
+
+async def serve(args: argparse.Namespace) -> None:
+    print("Loading model...")
+    sam = sam_model_registry[args.model_type](checkpoint=args.checkpoint)
+    _ = sam.to(device=args.device)
+    predictor = SamPredictor(sam, precision=args.precision)
+    async with SamService(
+        predictor,
+        max_encoder_batch=args.max_encoder_batch,
+        max_decoder_batch=args.max_decoder_batch,
+        max_wait_ms=args.max_wait_ms,
+    ) as service:
+        server = Server(service, args.max_images)
+        http_server = await asyncio.start_server(server.handle_connection, args.host, args.port)
+        print(f"Serving on http://{args.host}:{args.port}")
+        async with http_server:
+            await http_server.serve_forever()
+
+
+def main(args: argparse.Namespace) -> None:
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print("Done!")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,127 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import cv2  # type: ignore
+import torch
+
+from segment_anything import sam_model_registry
+from segment_anything.modeling import Sam
+from segment_anything.utils.transforms import ResizeLongestSide
+
+import argparse
+import os
+import time
+
+parser = argparse.ArgumentParser(
+    description=(
+        "Checks that the opt-in fused image preprocessing of SamPredictor, which resizes with "
+        "torch's antialiased uint8 kernel and normalizes and pads into a preallocated "
+        "buffer, matches the PIL based ResizeLongestSide.apply_image followed by "
+        "Sam.preprocess, and times both. Uses random images of several sizes unless "
+        "--input is given. No checkpoint is needed."
+    )
+)
+
+parser.add_argument(
+    "--input",
+    type=str,
+    default=None,
+    help="Path to either a single input image or folder of images. Requires open-cv.",
+)
+
+parser.add_argument("--image-size", type=int, default=1024, help="The model input size.")
+
+parser.add_argument("--repeats", type=int, default=5, help="Timed runs per image.")
+
+parser.add_argument(
+    "--max-diff",
+    type=int,
+    default=2,
+    help=(
+        "The largest difference in resized pixel values that is accepted. torch's uint8 "
+        "kernel rounds its weights to fewer fixed point bits than PIL, so a small fraction "
+        "of pixels may differ by 1 or 2."
+    ),
+)
+
+RANDOM_IMAGE_SIZES = [(480, 640), (1024, 1024), (333, 1777), (1500, 2000), (3000, 4000)]
+
+
+def pil_preprocess(sam: Sam, transform: ResizeLongestSide, image: np.ndarray) -> torch.Tensor:
+    # The default path of SamPredictor.set_image, for a BGR image
+    resized = transform.apply_image(image[..., ::-1])
+    resized_torch = torch.as_tensor(resized).permute(2, 0, 1).contiguous()
+    return sam.preprocess(resized_torch[None, :, :, :].float())[0]
+
+
+def fused_preprocess(
+    sam: Sam, transform: ResizeLongestSide, image: np.ndarray, out: torch.Tensor
+) -> torch.Tensor:
+    # The path of SamPredictor.set_image, for a BGR image
+    resized = transform.apply_image_uint8_torch(image)
+    return sam.preprocess_into(resized, out, flip_channels=True)
+
+
+def time_fn(fn, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def load_images(args: argparse.Namespace):
+    """Yields names and images in BGR format, as read by open-cv."""
+    if args.input is None:
+        rng = np.random.default_rng(0)
+        for h, w in RANDOM_IMAGE_SIZES:
+            yield f"random {h}x{w}", rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+        return
+    if not os.path.isdir(args.input):
+        targets = [args.input]
+    else:
+        targets = [os.path.join(args.input, f) for f in sorted(os.listdir(args.input))]
+    for t in targets:
+        image = cv2.imread(t)
+        if image is None:
+            print(f"Could not load '{t}' as an image, skipping...")
+            continue
+        yield t, image
+
+
+def main(args: argparse.Namespace) -> None:
+    print("Building a randomly initialized vit_b model...")
+    sam = sam_model_registry["vit_b"](image_size=args.image_size)
+    transform = ResizeLongestSide(args.image_size)
+    out = torch.empty(3, args.image_size, args.image_size)
+    failed = False
+    for name, image in load_images(args):
+        pil_resized = transform.apply_image(image).astype(np.int16)
+        fused_resized = transform.apply_image_uint8_torch(image)[0].permute(1, 2, 0).numpy()
+        diff = np.abs(pil_resized - fused_resized)
+        pil_input = pil_preprocess(sam, transform, image)
+        fused_input = fused_preprocess(sam, transform, image, out)
+        input_diff = (pil_input - fused_input).abs().max().item()
+
+        pil_s = time_fn(lambda: pil_preprocess(sam, transform, image), args.repeats)
+        fused_s = time_fn(lambda: fused_preprocess(sam, transform, image, out), args.repeats)
+        failed = failed or diff.max() > args.max_diff
+        print(
+            f"{name}: max pixel diff {diff.max()}, {(diff > 0).mean() * 100:.2f}% of pixels "
+            f"differ, max model input diff {input_diff:.3f}; PIL {pil_s * 1000:.1f}ms, "
+            f"fused {fused_s * 1000:.1f}ms"
+        )
+    if failed:
+        raise SystemExit(f"Resized pixels differ from PIL by more than {args.max_diff}.")
+    print("Done!")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with torch.no_grad():
+        main(args)
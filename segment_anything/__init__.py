@@ -9,7 +9,11 @@ from .build_sam import (
     build_sam_vit_h,
     build_sam_vit_l,
     build_sam_vit_b,
+    build_sam_decoder,
+    load_sam_state_dict,
     sam_model_registry,
 )
-from .predictor import SamPredictor
+from .predictor import EmbeddingCache, ImageEmbedding, SamPredictor, SamPromptPredictor
 from .automatic_mask_generator import SamAutomaticMaskGenerator
+from .embedding_store import EmbeddingStore
+from .service import SamService
@@ -11,7 +11,7 @@ from torchvision.ops.boxes import batched_nms, box_area  # type: ignore
 from typing import Any, Dict, List, Optional, Tuple
 
 from .modeling import Sam
-from .predictor import SamPredictor
+from .predictor import EmbeddingCache, ImageEmbedding, SamPredictor
 from .utils.amg import (
     MaskData,
     area_from_rle,
@@ -49,6 +49,10 @@ class SamAutomaticMaskGenerator:
         point_grids: Optional[List[np.ndarray]] = None,
         min_mask_region_area: int = 0,
         output_mode: str = "binary_mask",
+        crops_per_batch: int = 1,
+        precision: str = "fp32",
+        embedding_cache: Optional[EmbeddingCache] = None,
+        model_id: Optional[str] = None,
     ) -> None:
         """
         Using a SAM model, generates masks for the entire image.
@@ -93,6 +97,19 @@ class SamAutomaticMaskGenerator:
             'uncompressed_rle', or 'coco_rle'. 'coco_rle' requires pycocotools.
             For large resolutions, 'binary_mask' may consume large amounts of
             memory.
+          crops_per_batch (int): Sets the number of image crops embedded
+            simultaneously by the image encoder. Higher numbers may be faster
+            on many-core CPUs but use more memory.
+          precision (str): The precision to run the image encoder and mask
+            decoder at, 'fp32' or 'bf16'. Mask filtering, including the
+            stability score, always runs on fp32 logits.
+          embedding_cache (EmbeddingCache or None): If set, crop embeddings
+            are looked up in and added to this cache, so that rerunning mask
+            generation on the same image, for example with other thresholds,
+            skips the image encoder.
+          model_id (str or None): Identifies the model in embedding cache
+            keys, see SamPredictor. If None, a fingerprint of the model is
+            used.
         """
 
         assert (points_per_side is None) != (
@@ -120,7 +137,9 @@ class SamAutomaticMaskGenerator:
         if min_mask_region_area > 0:
             import cv2  # type: ignore # noqa: F401
 
-        self.predictor = SamPredictor(model)
+        self.predictor = SamPredictor(
+            model, precision=precision, embedding_cache=embedding_cache, model_id=model_id
+        )
         self.points_per_batch = points_per_batch
         self.pred_iou_thresh = pred_iou_thresh
         self.stability_score_thresh = stability_score_thresh
@@ -132,6 +151,7 @@ class SamAutomaticMaskGenerator:
         self.crop_n_points_downscale_factor = crop_n_points_downscale_factor
         self.min_mask_region_area = min_mask_region_area
         self.output_mode = output_mode
+        self.crops_per_batch = crops_per_batch
 
     @torch.no_grad()
     def generate(self, image: np.ndarray) -> List[Dict[str, Any]]:
@@ -200,11 +220,19 @@ class SamAutomaticMaskGenerator:
             orig_size, self.crop_n_layers, self.crop_overlap_ratio
         )
 
-        # Iterate over image crops
+        # Iterate over image crops, embedding them in batches
         data = MaskData()
-        for crop_box, layer_idx in zip(crop_boxes, layer_idxs):
-            crop_data = self._process_crop(image, crop_box, layer_idx, orig_size)
-            data.cat(crop_data)
+        for batch_crop_boxes, batch_layer_idxs in batch_iterator(
+            self.crops_per_batch, crop_boxes, layer_idxs
+        ):
+            cropped_ims = [image[y0:y1, x0:x1, :] for x0, y0, x1, y1 in batch_crop_boxes]
+            embeddings = self.predictor.encode_batch(cropped_ims)
+            for crop_box, layer_idx, embedding in zip(
+                batch_crop_boxes, batch_layer_idxs, embeddings
+            ):
+                crop_data = self._process_crop(embedding, crop_box, layer_idx, orig_size)
+                data.cat(crop_data)
+            del embeddings
 
         # Remove duplicate masks between crops
         if len(crop_boxes) > 1:
@@ -224,16 +252,12 @@ class SamAutomaticMaskGenerator:
 
     def _process_crop(
         self,
-        image: np.ndarray,
+        embedding: ImageEmbedding,
         crop_box: List[int],
         crop_layer_idx: int,
         orig_size: Tuple[int, ...],
     ) -> MaskData:
-        # Crop the image and calculate embeddings
-        x0, y0, x1, y1 = crop_box
-        cropped_im = image[y0:y1, x0:x1, :]
-        cropped_im_size = cropped_im.shape[:2]
-        self.predictor.set_image(cropped_im)
+        cropped_im_size = embedding.original_size
 
         # Get points for this crop
         points_scale = np.array(cropped_im_size)[None, ::-1]
@@ -242,10 +266,11 @@ class SamAutomaticMaskGenerator:
         # Generate masks for this crop in batches
         data = MaskData()
         for (points,) in batch_iterator(self.points_per_batch, points_for_image):
-            batch_data = self._process_batch(points, cropped_im_size, crop_box, orig_size)
+            batch_data = self._process_batch(
+                points, embedding, cropped_im_size, crop_box, orig_size
+            )
             data.cat(batch_data)
             del batch_data
-        self.predictor.reset_image()
 
         # Remove duplicates within this crop.
         keep_by_nms = batched_nms(
@@ -266,6 +291,7 @@ class SamAutomaticMaskGenerator:
     def _process_batch(
         self,
         points: np.ndarray,
+        embedding: ImageEmbedding,
         im_size: Tuple[int, ...],
         crop_box: List[int],
         orig_size: Tuple[int, ...],
@@ -281,6 +307,7 @@ class SamAutomaticMaskGenerator:
             in_labels[:, None],
             multimask_output=True,
             return_logits=True,
+            embedding=embedding,
         )
 
         # Serialize predictions and store in MaskData
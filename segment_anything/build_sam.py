@@ -5,42 +5,60 @@
 # LICENSE file in the root directory of this source tree.
 
 import torch
+from torch.nn import functional as F
 
+import hashlib
+import inspect
+import json
+import os
+from contextlib import nullcontext
 from functools import partial
 
-from .modeling import ImageEncoderViT, MaskDecoder, PromptEncoder, Sam, TwoWayTransformer
+from .modeling import (
+    ImageEncoderViT,
+    MaskDecoder,
+    PromptEncoder,
+    Sam,
+    SamPromptDecoder,
+    TwoWayTransformer,
+)
+from .utils.checkpoint import load_safetensors, save_safetensors
+from .utils.io import atomic_write
 
 
-def build_sam_vit_h(checkpoint=None):
+def build_sam_vit_h(checkpoint=None, **kwargs):
     return _build_sam(
         encoder_embed_dim=1280,
         encoder_depth=32,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[7, 15, 23, 31],
         checkpoint=checkpoint,
+        **kwargs,
     )
 
 
 build_sam = build_sam_vit_h
 
 
-def build_sam_vit_l(checkpoint=None):
+def build_sam_vit_l(checkpoint=None, **kwargs):
     return _build_sam(
         encoder_embed_dim=1024,
         encoder_depth=24,
         encoder_num_heads=16,
         encoder_global_attn_indexes=[5, 11, 17, 23],
         checkpoint=checkpoint,
+        **kwargs,
     )
 
 
-def build_sam_vit_b(checkpoint=None):
+def build_sam_vit_b(checkpoint=None, **kwargs):
     return _build_sam(
         encoder_embed_dim=768,
         encoder_depth=12,
         encoder_num_heads=12,
         encoder_global_attn_indexes=[2, 5, 8, 11],
         checkpoint=checkpoint,
+        **kwargs,
     )
 
 
@@ -58,13 +76,30 @@ def _build_sam(
     encoder_num_heads,
     encoder_global_attn_indexes,
     checkpoint=None,
+    encoder_attn_impl="eager",
+    encoder_cache_rel_pos=False,
+    encoder_global_attn_max_bytes=None,
+    image_size=1024,
+    encoder_skip_padding_windows=False,
+    decoder_attn_impl="eager",
+    quantize_encoder=False,
+    cache_dir=None,
+    checkpoint_mmap=False,
 ):
+    if cache_dir is not None:
+        build_kwargs = {k: v for k, v in locals().items() if k != "cache_dir"}
+        return _build_sam_cached(cache_dir, build_kwargs)
+
     prompt_embed_dim = 256
-    image_size = 1024
     vit_patch_size = 16
-    image_embedding_size = image_size // vit_patch_size
-    sam = Sam(
-        image_encoder=ImageEncoderViT(
+    assert (
+        image_size % vit_patch_size == 0
+    ), f"image_size must be a multiple of the patch size {vit_patch_size}."
+    # With a checkpoint, parameters are created on the meta device without
+    # initialization and then replaced by the checkpoint tensors.
+    skip_init = checkpoint is not None and _supports_meta_init()
+    with torch.device("meta") if skip_init else nullcontext():
+        image_encoder = ImageEncoderViT(
             depth=encoder_depth,
             embed_dim=encoder_embed_dim,
             img_size=image_size,
@@ -77,31 +112,240 @@ def _build_sam(
             global_attn_indexes=encoder_global_attn_indexes,
             window_size=14,
             out_chans=prompt_embed_dim,
-        ),
-        prompt_encoder=PromptEncoder(
-            embed_dim=prompt_embed_dim,
-            image_embedding_size=(image_embedding_size, image_embedding_size),
-            input_image_size=(image_size, image_size),
-            mask_in_chans=16,
-        ),
-        mask_decoder=MaskDecoder(
-            num_multimask_outputs=3,
-            transformer=TwoWayTransformer(
-                depth=2,
-                embedding_dim=prompt_embed_dim,
-                mlp_dim=2048,
-                num_heads=8,
-            ),
-            transformer_dim=prompt_embed_dim,
-            iou_head_depth=3,
-            iou_head_hidden_dim=256,
-        ),
+            attn_impl=encoder_attn_impl,
+            cache_rel_pos=encoder_cache_rel_pos,
+            global_attn_max_bytes=encoder_global_attn_max_bytes,
+            skip_padding_windows=encoder_skip_padding_windows,
+        )
+        prompt_encoder, mask_decoder = _build_prompt_modules(
+            prompt_embed_dim, image_size, vit_patch_size, decoder_attn_impl
+        )
+    sam = Sam(
+        image_encoder=image_encoder,
+        prompt_encoder=prompt_encoder,
+        mask_decoder=mask_decoder,
         pixel_mean=[123.675, 116.28, 103.53],
         pixel_std=[58.395, 57.12, 57.375],
     )
     sam.eval()
     if checkpoint is not None:
+        state_dict = load_sam_state_dict(checkpoint, mmap=checkpoint_mmap)
+        state_dict = _resample_pos_embeds(state_dict, sam)
+        sam.load_state_dict(state_dict, **({"assign": True} if skip_init else {}))
+    if quantize_encoder:
+        sam.image_encoder = _quantize_image_encoder(sam.image_encoder)
+    return sam
+
+
+def build_sam_decoder(
+    checkpoint=None, image_size=1024, checkpoint_mmap=True, decoder_attn_impl="eager"
+):
+    """
+    Builds only the prompt encoder and mask decoder of SAM, for workers that
+    predict masks from precomputed image embeddings with SamPromptPredictor.
+    These are the same for every model type, so the checkpoint of any model
+    type can be used and only its prompt encoder and mask decoder weights are
+    loaded. image_size must match the model the embeddings are computed with.
+
+    These weights are a few MB of a checkpoint that is mostly image encoder,
+    so torch pickle checkpoints are memory-mapped by default, where torch
+    supports it, and the image encoder weights are never read. Pass
+    checkpoint_mmap=False for legacy checkpoints not in the zipfile format.
+    """
+    prompt_embed_dim = 256
+    vit_patch_size = 16
+    assert (
+        image_size % vit_patch_size == 0
+    ), f"image_size must be a multiple of the patch size {vit_patch_size}."
+    skip_init = checkpoint is not None and _supports_meta_init()
+    with torch.device("meta") if skip_init else nullcontext():
+        prompt_encoder, mask_decoder = _build_prompt_modules(
+            prompt_embed_dim, image_size, vit_patch_size, decoder_attn_impl
+        )
+    model = SamPromptDecoder(prompt_encoder, mask_decoder, img_size=image_size)
+    model.eval()
+    if checkpoint is not None:
+        state_dict = load_sam_state_dict(
+            checkpoint, components=["prompt_encoder", "mask_decoder"], mmap=checkpoint_mmap
+        )
+        model.load_state_dict(state_dict, **({"assign": True} if skip_init else {}))
+    return model
+
+
+def _build_prompt_modules(prompt_embed_dim, image_size, vit_patch_size, attn_impl="eager"):
+    image_embedding_size = image_size // vit_patch_size
+    prompt_encoder = PromptEncoder(
+        embed_dim=prompt_embed_dim,
+        image_embedding_size=(image_embedding_size, image_embedding_size),
+        input_image_size=(image_size, image_size),
+        mask_in_chans=16,
+    )
+    mask_decoder = MaskDecoder(
+        num_multimask_outputs=3,
+        transformer=TwoWayTransformer(
+            depth=2,
+            embedding_dim=prompt_embed_dim,
+            mlp_dim=2048,
+            num_heads=8,
+            attn_impl=attn_impl,
+        ),
+        transformer_dim=prompt_embed_dim,
+        iou_head_depth=3,
+        iou_head_hidden_dim=256,
+    )
+    return prompt_encoder, mask_decoder
+
+
+SAM_COMPONENTS = ["image_encoder", "prompt_encoder", "mask_decoder"]
+
+
+def load_sam_state_dict(checkpoint, components=None, mmap=False):
+    """
+    Loads the state dict of a SAM checkpoint, either a torch pickle or a
+    .safetensors file as written by scripts/convert_checkpoint_to_safetensors.py.
+    Safetensors checkpoints are memory-mapped without a copy, and tensors of
+    components that are not requested are never read.
+
+    Arguments:
+      checkpoint (str): The path to the checkpoint.
+      components (list(str) or None): If set, only the weights of these
+        components are loaded, from 'image_encoder', 'prompt_encoder' and
+        'mask_decoder'. Keys keep their component prefix.
+      mmap (bool): Whether to memory-map a torch pickle checkpoint instead of
+        reading it into memory. Ignored on torch versions before 2.1, which
+        can't. Safetensors checkpoints are always mapped.
+
+    Returns:
+      (dict(str, torch.Tensor)): The state dict.
+    """
+    prefixes = None
+    if components is not None:
+        for component in components:
+            assert component in SAM_COMPONENTS, f"Unknown component {component}."
+        prefixes = [component + "." for component in components]
+
+    if checkpoint.endswith(".safetensors"):
+        return load_safetensors(checkpoint, prefixes=prefixes)
+    if mmap and _supports_mmap_load():
+        # The checkpoint's storages are mapped from disk rather than read into memory
+        state_dict = torch.load(checkpoint, mmap=True)
+    else:
         with open(checkpoint, "rb") as f:
             state_dict = torch.load(f)
-        sam.load_state_dict(state_dict)
+    if prefixes is not None:
+        state_dict = {k: v for k, v in state_dict.items() if k.startswith(tuple(prefixes))}
+    return state_dict
+
+
+def _supports_meta_init():
+    """Whether modules can be built on the meta device and loaded with assign=True."""
+    return hasattr(torch.device, "__enter__") and (
+        "assign" in inspect.signature(torch.nn.Module.load_state_dict).parameters
+    )
+
+
+def _supports_mmap_load():
+    """Whether torch.load can memory-map a checkpoint, added in torch 2.1."""
+    return "mmap" in inspect.signature(torch.load).parameters
+
+
+def _build_sam_cached(cache_dir, build_kwargs):
+    """
+    Builds the model with build_kwargs from a weights artifact in cache_dir,
+    or builds it with _build_sam and saves the artifact. The artifact is the
+    model's state dict, after positional embeddings are resampled to
+    image_size, as a safetensors file. Loading it memory-maps the weights
+    into modules built on the meta device from the current code, so later
+    processes skip random initialization and reading the original checkpoint,
+    and nothing is unpickled. Quantization is applied after loading.
+    Artifacts are keyed by the build options, the checkpoint's path, size and
+    modification time, the torch version and a hash of the segment_anything
+    source, so a changed checkpoint, torch upgrade or code change produces a
+    new artifact.
+    """
+    key = {
+        k: v
+        for k, v in build_kwargs.items()
+        if k not in ["checkpoint", "checkpoint_mmap", "quantize_encoder"]
+    }
+    checkpoint = build_kwargs["checkpoint"]
+    if checkpoint is not None:
+        stat = os.stat(checkpoint)
+        key["checkpoint"] = [os.path.abspath(checkpoint), stat.st_size, stat.st_mtime_ns]
+    key["torch_version"] = torch.__version__
+    key["source_digest"] = _source_digest()
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"sam_{digest}.safetensors")
+
+    if os.path.exists(path):
+        return _build_sam(**{**build_kwargs, "checkpoint": path})
+
+    sam = _build_sam(**{**build_kwargs, "quantize_encoder": False})
+    os.makedirs(cache_dir, exist_ok=True)
+    with atomic_write(path) as tmp_path:
+        save_safetensors(sam.state_dict(), tmp_path)
+    if build_kwargs["quantize_encoder"]:
+        sam.image_encoder = _quantize_image_encoder(sam.image_encoder)
     return sam
+
+
+def _source_digest():
+    """A hash of the segment_anything source files."""
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    hasher = hashlib.sha256()
+    for root, dirs, files in os.walk(package_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(".py"):
+                path = os.path.join(root, name)
+                hasher.update(os.path.relpath(path, package_dir).encode())
+                with open(path, "rb") as f:
+                    hasher.update(f.read())
+    return hasher.hexdigest()
+
+
+def _quantize_image_encoder(image_encoder):
+    """
+    Applies int8 dynamic quantization to the nn.Linear layers of the image
+    encoder: the attention qkv and proj layers and the MLP layers of every
+    block. Weights are stored as int8 and activations are quantized on the fly,
+    while the patch embedding, the neck and all norms stay in fp32. Dynamic
+    quantization is only supported on CPU, so the model should not be moved to
+    another device afterwards.
+    """
+    from torch.ao.quantization import quantize_dynamic
+
+    return quantize_dynamic(image_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def _resample_pos_embeds(state_dict, model):
+    """
+    Resamples the absolute positional embedding and the relative positional
+    embeddings of a checkpoint to the shapes expected by the model. This
+    allows a checkpoint trained at 1024x1024 to be loaded into a model built
+    with a different image_size.
+    """
+    model_state_dict = model.state_dict()
+    for k, v in state_dict.items():
+        if k not in model_state_dict or model_state_dict[k].shape == v.shape:
+            continue
+        target_shape = model_state_dict[k].shape
+        if k.endswith("pos_embed"):
+            # 1xHxWxC, resampled as an image
+            v = F.interpolate(
+                v.permute(0, 3, 1, 2).float(),
+                size=target_shape[1:3],
+                mode="bicubic",
+                align_corners=False,
+            )
+            state_dict[k] = v.permute(0, 2, 3, 1).to(state_dict[k].dtype)
+        elif k.endswith("rel_pos_h") or k.endswith("rel_pos_w"):
+            # LxC, resampled linearly along L as in get_rel_pos
+            v = F.interpolate(
+                v.t().unsqueeze(0).float(),
+                size=target_shape[0],
+                mode="linear",
+                align_corners=False,
+            )
+            state_dict[k] = v.squeeze(0).t().to(state_dict[k].dtype)
+    return state_dict
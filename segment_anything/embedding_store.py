@@ -0,0 +1,125 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from .predictor import ImageEmbedding
+from .utils.io import atomic_write
+
+
+class EmbeddingStore:
+    def __init__(self, path: str, dtype: str = "float32") -> None:
+        """
+        A persistent store of image embeddings for whole datasets, so the
+        image encoder can be run once in batch and decoder-only workloads can
+        read the embeddings later. The features of all entries are appended to
+        a single flat file, and a json index maps each image id to its byte
+        offset, shape and image sizes. Reads memory-map the file, so 'get'
+        returns embeddings that view the file without a copy, and processes
+        reading the same store share its pages through the page cache.
+
+        Embeddings from 'get' can be set on a SamPredictor or
+        SamPromptPredictor with 'set_embedding' or passed to 'predict'. Their
+        features are CPU tensors, and 'features.numpy()' gives the array
+        expected by the ONNX decoder without a copy.
+
+        A store has a single writer. Entries written with 'add' become
+        visible to other processes after 'flush'.
+
+        Arguments:
+          path (str): The folder of the store. Created if it does not exist.
+          dtype (str): The dtype features are stored in, 'float32' or
+            'float16'. Only used when creating a new store.
+        """
+        assert dtype in ["float32", "float16"], f"Unknown dtype {dtype}."
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._data_path = os.path.join(path, "embeddings.bin")
+        self._index_path = os.path.join(path, "index.json")
+        self._lock = threading.Lock()
+        self._memmap: Optional[np.memmap] = None
+
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.dtype = dtype
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r") as f:
+                index = json.load(f)
+            self.dtype = index["dtype"]
+            self.entries = index["entries"]
+        self._num_bytes = os.path.getsize(self._data_path) if os.path.exists(self._data_path) else 0
+
+    def add(self, image_id: str, embedding: ImageEmbedding) -> None:
+        """
+        Appends an embedding to the store. Adding an existing image id points
+        it at the new embedding.
+
+        Arguments:
+          image_id (str): The id to store the embedding under.
+          embedding (ImageEmbedding): The embedding, for example as returned
+            by SamPredictor.encode_batch.
+        """
+        features = embedding.features.detach().to(device="cpu", dtype=getattr(torch, self.dtype))
+        data = features.contiguous().numpy().tobytes()
+        with self._lock:
+            with open(self._data_path, "ab") as f:
+                f.write(data)
+            self.entries[image_id] = {
+                "offset": self._num_bytes,
+                "shape": list(features.shape),
+                "input_size": list(embedding.input_size),
+                "original_size": list(embedding.original_size),
+            }
+            self._num_bytes += len(data)
+
+    def flush(self) -> None:
+        """Writes the index, making added entries visible to other readers."""
+        with self._lock:
+            index = {"dtype": self.dtype, "entries": self.entries}
+            with atomic_write(self._index_path) as tmp_path:
+                with open(tmp_path, "w") as f:
+                    json.dump(index, f)
+
+    def get(self, image_id: str) -> ImageEmbedding:
+        """
+        Returns the embedding stored under image_id. Its features view the
+        memory-mapped store without a copy.
+
+        Arguments:
+          image_id (str): The id the embedding was stored under.
+
+        Returns:
+          (ImageEmbedding): The embedding, with features on CPU.
+        """
+        entry = self.entries[image_id]
+        np_dtype = np.dtype(self.dtype)
+        num_bytes = int(np.prod(entry["shape"])) * np_dtype.itemsize
+        with self._lock:
+            end = entry["offset"] + num_bytes
+            if self._memmap is None or len(self._memmap) < end:
+                # Copy-on-write, so tensors are writable while the file is never modified
+                self._memmap = np.memmap(self._data_path, dtype=np.uint8, mode="c")
+            data = self._memmap[entry["offset"] : end]
+        features = torch.from_numpy(data.view(np_dtype).reshape(entry["shape"]))
+        return ImageEmbedding(
+            features=features,
+            input_size=tuple(entry["input_size"]),
+            original_size=tuple(entry["original_size"]),
+        )
+
+    def keys(self) -> List[str]:
+        return list(self.entries.keys())
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
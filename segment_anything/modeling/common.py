@@ -36,8 +36,20 @@ class LayerNorm2d(nn.Module):
         self.eps = eps
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Normalized in fp32 so reduced precision inputs keep their statistics exact
+        dtype = x.dtype
+        x = x.float()
         u = x.mean(1, keepdim=True)
         s = (x - u).pow(2).mean(1, keepdim=True)
         x = (x - u) / torch.sqrt(s + self.eps)
-        x = self.weight[:, None, None] * x + self.bias[:, None, None]
-        return x
+        x = self.weight[:, None, None].float() * x + self.bias[:, None, None].float()
+        return x.to(dtype)
+
+
+def inference_mode_enabled() -> bool:
+    """
+    Whether torch.inference_mode is active. Tensors created in inference mode
+    can't be used outside of it, so caches of such tensors key on this. Always
+    False on torch versions before 1.9, which have no inference mode.
+    """
+    return hasattr(torch, "is_inference_mode_enabled") and torch.is_inference_mode_enabled()
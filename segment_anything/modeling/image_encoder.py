@@ -8,9 +8,10 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from typing import Optional, Tuple, Type
+import math
+from typing import List, Optional, Tuple, Type
 
-from .common import LayerNorm2d, MLPBlock
+from .common import LayerNorm2d, MLPBlock, inference_mode_enabled
 
 
 # This class and its supporting functions below lightly adapted from the ViTDet backbone available at: https://github.com/facebookresearch/detectron2/blob/main/detectron2/modeling/backbone/vit.py # noqa
@@ -33,6 +34,10 @@ class ImageEncoderViT(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         global_attn_indexes: Tuple[int, ...] = (),
+        attn_impl: str = "eager",
+        cache_rel_pos: bool = False,
+        global_attn_max_bytes: Optional[int] = None,
+        skip_padding_windows: bool = False,
     ) -> None:
         """
         Args:
@@ -51,9 +56,32 @@ class ImageEncoderViT(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             window_size (int): Window size for window attention blocks.
             global_attn_indexes (list): Indexes for blocks using global attention.
+            attn_impl (str): Attention backend, in ['eager', 'sdpa']. 'sdpa' uses
+                torch's fused scaled_dot_product_attention with the relative
+                positional embeddings passed as an additive bias.
+            cache_rel_pos (bool): If True, reuse the relative positional tables of each
+                block across inference calls instead of rebuilding them every forward.
+            global_attn_max_bytes (int or None): If set, the global attention blocks process
+                queries in chunks so that each chunk of the attention map takes about this
+                many bytes. This caps the peak memory of the encoder. See Attention for how
+                chunking affects the result.
+            skip_padding_windows (bool): If True and the unpadded input sizes are passed to
+                forward, the window attention blocks before the first global attention block
+                skip the attention and MLP of windows that lie entirely in the padded region.
+                Until the first global block, such windows only see padding tokens, whose
+                values don't depend on the image, so their outputs are computed once from a
+                blank image and written back. The result is the same as the full computation.
         """
         super().__init__()
         self.img_size = img_size
+        self.patch_size = patch_size
+        self.window_size = window_size
+        self.skip_padding_windows = skip_padding_windows
+        # Blocks before the first global block process each window independently
+        self.num_leading_window_blocks = (
+            min(min(global_attn_indexes, default=depth), depth) if window_size > 0 else 0
+        )
+        self._padding_cache: Optional[Tuple[Tuple, torch.Tensor]] = None
 
         self.patch_embed = PatchEmbed(
             kernel_size=(patch_size, patch_size),
@@ -82,6 +110,9 @@ class ImageEncoderViT(nn.Module):
                 rel_pos_zero_init=rel_pos_zero_init,
                 window_size=window_size if i not in global_attn_indexes else 0,
                 input_size=(img_size // patch_size, img_size // patch_size),
+                attn_impl=attn_impl,
+                cache_rel_pos=cache_rel_pos,
+                max_attn_bytes=global_attn_max_bytes if i in global_attn_indexes else None,
             )
             self.blocks.append(block)
 
@@ -103,18 +134,102 @@ class ImageEncoderViT(nn.Module):
             LayerNorm2d(out_chans),
         )
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(
+        self, x: torch.Tensor, input_sizes: Optional[List[Tuple[int, ...]]] = None
+    ) -> torch.Tensor:
+        """
+        Args:
+            x (tensor): padded input images with [B, C, img_size, img_size].
+            input_sizes (list(tuple(int, int)) or None): the size of each image before
+                padding, as (H, W). Only used if skip_padding_windows is True.
+
+        Returns:
+            x (tensor): image embeddings with [B, out_chans, H / patch_size, W / patch_size].
+        """
+        image_size = (x.shape[2], x.shape[3])
         x = self.patch_embed(x)
         if self.pos_embed is not None:
             x = x + self.pos_embed
 
-        for blk in self.blocks:
+        window_keep, padding_tokens = None, None
+        num_leading = self.num_leading_window_blocks
+        if self.skip_padding_windows and input_sizes is not None and num_leading > 0:
+            keep = self._get_nonpadding_windows(x.shape[1], x.shape[2], input_sizes)
+            if keep is not None:
+                window_keep = keep.flatten().nonzero().squeeze(1).to(x.device)
+                padding_tokens = keep.logical_not()
+                for dim in [1, 2]:
+                    padding_tokens = padding_tokens.repeat_interleave(self.window_size, dim)
+                padding_tokens = padding_tokens[:, : x.shape[1], : x.shape[2], None].to(x.device)
+
+        for blk in self.blocks[:num_leading]:
+            x = blk(x, window_keep=window_keep)
+        if padding_tokens is not None:
+            x = torch.where(padding_tokens, self._get_padding_outputs(x, image_size), x)
+        for blk in self.blocks[num_leading:]:
             x = blk(x)
 
         x = self.neck(x.permute(0, 3, 1, 2))
 
         return x
 
+    def extra_repr(self) -> str:
+        # Part of repr(model), so embedding caches keyed on it tell this option apart
+        return f"skip_padding_windows={self.skip_padding_windows}"
+
+    def _get_nonpadding_windows(
+        self, H: int, W: int, input_sizes: List[Tuple[int, ...]]
+    ) -> Optional[torch.Tensor]:
+        """
+        Returns a mask with shape [B, nWin_h, nWin_w] of the windows that contain at
+        least one token of unpadded image content, or None if all do.
+        """
+        n_h = math.ceil(H / self.window_size)
+        n_w = math.ceil(W / self.window_size)
+        keep = torch.zeros(len(input_sizes), n_h, n_w, dtype=torch.bool)
+        for i, (h, w) in enumerate(input_sizes):
+            # Number of windows touched by the tokens of the unpadded image
+            keep_h = math.ceil(math.ceil(h / self.patch_size) / self.window_size)
+            keep_w = math.ceil(math.ceil(w / self.patch_size) / self.window_size)
+            keep[i, :keep_h, :keep_w] = True
+        if keep.all():
+            return None
+        return keep
+
+    def _get_padding_outputs(self, x: torch.Tensor, image_size: Tuple[int, int]) -> torch.Tensor:
+        """
+        Returns the output of the leading window attention blocks for a blank input
+        of image_size, with shape [1, H, W, C]. This is also the output of every
+        all-padding window for any image. Without grad, it is reused until the
+        parameters are moved, replaced or updated in place, or the dtype changes.
+        """
+        leading_blocks = self.blocks[: self.num_leading_window_blocks]
+        use_cache = not torch.is_grad_enabled()
+        if use_cache:
+            params = list(self.patch_embed.parameters()) + list(leading_blocks.parameters())
+            if self.pos_embed is not None:
+                params.append(self.pos_embed)
+            key = (
+                image_size,
+                x.dtype,
+                inference_mode_enabled(),
+                tuple((p.data_ptr(), p._version) for p in params),
+            )
+            if self._padding_cache is not None and self._padding_cache[0] == key:
+                return self._padding_cache[1]
+
+        # Padding pixels are zeros after Sam.preprocess
+        proj = self.patch_embed.proj
+        blank = proj.weight.new_zeros(1, proj.in_channels, *image_size)
+        padding_outputs = self.patch_embed(blank)
+        if self.pos_embed is not None:
+            padding_outputs = padding_outputs + self.pos_embed
+        for blk in leading_blocks:
+            padding_outputs = blk(padding_outputs)
+        if use_cache:
+            self._padding_cache = (key, padding_outputs)
+        return padding_outputs
+
 
 class Block(nn.Module):
     """Transformer blocks with support of window attention and residual propagation blocks"""
@@ -131,6 +246,9 @@ class Block(nn.Module):
         rel_pos_zero_init: bool = True,
         window_size: int = 0,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_impl: str = "eager",
+        cache_rel_pos: bool = False,
+        max_attn_bytes: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -146,6 +264,11 @@ class Block(nn.Module):
                 use global attention.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_impl (str): Attention backend, in ['eager', 'sdpa'].
+            cache_rel_pos (bool): If True, reuse the relative positional tables across
+                inference calls.
+            max_attn_bytes (int or None): If set, the memory budget in bytes for each chunk
+                of the attention map.
         """
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -156,6 +279,9 @@ class Block(nn.Module):
             use_rel_pos=use_rel_pos,
             rel_pos_zero_init=rel_pos_zero_init,
             input_size=input_size if window_size == 0 else (window_size, window_size),
+            attn_impl=attn_impl,
+            cache_rel_pos=cache_rel_pos,
+            max_attn_bytes=max_attn_bytes,
         )
 
         self.norm2 = norm_layer(dim)
@@ -163,7 +289,10 @@ class Block(nn.Module):
 
         self.window_size = window_size
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, window_keep: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if self.window_size > 0 and window_keep is not None:
+            return self._forward_kept_windows(x, window_keep)
+
         shortcut = x
         x = self.norm1(x)
         # Window partition
@@ -181,6 +310,22 @@ class Block(nn.Module):
 
         return x
 
+    def _forward_kept_windows(self, x: torch.Tensor, window_keep: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the block only on the windows with indices window_keep, as ordered by
+        window_partition. The tokens of all other windows are returned unchanged.
+        """
+        H, W = x.shape[1], x.shape[2]
+        # Normalize before partitioning so padding tokens are zeros, as in forward
+        windows, pad_hw = window_partition(self.norm1(x), self.window_size)
+        shortcut, _ = window_partition(x, self.window_size)
+
+        kept = shortcut[window_keep] + self.attn(windows[window_keep])
+        kept = kept + self.mlp(self.norm2(kept))
+
+        x = shortcut.index_copy(0, window_keep, kept)
+        return window_unpartition(x, self.window_size, pad_hw, (H, W))
+
 
 class Attention(nn.Module):
     """Multi-head Attention block with relative position embeddings."""
@@ -193,6 +338,9 @@ class Attention(nn.Module):
         use_rel_pos: bool = False,
         rel_pos_zero_init: bool = True,
         input_size: Optional[Tuple[int, int]] = None,
+        attn_impl: str = "eager",
+        cache_rel_pos: bool = False,
+        max_attn_bytes: Optional[int] = None,
     ) -> None:
         """
         Args:
@@ -203,8 +351,27 @@ class Attention(nn.Module):
             rel_pos_zero_init (bool): If True, zero initialize relative positional parameters.
             input_size (tuple(int, int) or None): Input resolution for calculating the relative
                 positional parameter size.
+            attn_impl (str): Attention backend, in ['eager', 'sdpa']. 'eager' computes the
+                full attention map explicitly, 'sdpa' uses the fused
+                scaled_dot_product_attention kernel.
+            cache_rel_pos (bool): If True, the interpolated and gathered relative
+                positional tables are kept between forward passes when running without
+                gradients, and only rebuilt if the input resolution or the parameters change.
+            max_attn_bytes (int or None): If set, queries are processed in chunks so that
+                the attention map of each chunk takes about this many bytes. Chunks have at
+                least 64 queries, so a very small budget can be exceeded. With chunks this
+                large, the CPU result matches the unchunked one exactly, but other backends
+                may pick other matmul kernels per chunk size, so in general the result only
+                agrees to within rounding (about 1e-6 relative in fp32).
         """
         super().__init__()
+        assert attn_impl in ["eager", "sdpa"], f"Unknown attn_impl {attn_impl}."
+        if attn_impl == "sdpa":
+            assert hasattr(
+                F, "scaled_dot_product_attention"
+            ), "attn_impl='sdpa' requires torch>=2.0."
+        self.attn_impl = attn_impl
+        self.max_attn_bytes = max_attn_bytes
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
@@ -221,6 +388,42 @@ class Attention(nn.Module):
             self.rel_pos_h = nn.Parameter(torch.zeros(2 * input_size[0] - 1, head_dim))
             self.rel_pos_w = nn.Parameter(torch.zeros(2 * input_size[1] - 1, head_dim))
 
+        self.cache_rel_pos = cache_rel_pos
+        self._rel_pos_cache: Optional[Tuple[Tuple, torch.Tensor, torch.Tensor]] = None
+
+    def extra_repr(self) -> str:
+        # The backend and chunking change the embeddings within rounding
+        return f"attn_impl={self.attn_impl}, max_attn_bytes={self.max_attn_bytes}"
+
+    def get_rel_pos_tables(
+        self, q_size: Tuple[int, int], k_size: Tuple[int, int]
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Returns the relative positional tables Rh with shape (q_h, k_h, C) and
+        Rw with shape (q_w, k_w, C) for the given query and key sizes, reusing
+        the cached tables if caching is enabled and they are still valid.
+        """
+        use_cache = self.cache_rel_pos and not torch.is_grad_enabled()
+        if use_cache:
+            # The key changes if the sizes change, if the parameters are moved or
+            # replaced (data_ptr), or if they are updated in place (_version).
+            key = (
+                q_size,
+                k_size,
+                self.rel_pos_h.data_ptr(),
+                self.rel_pos_h._version,
+                self.rel_pos_w.data_ptr(),
+                self.rel_pos_w._version,
+            )
+            if self._rel_pos_cache is not None and self._rel_pos_cache[0] == key:
+                return self._rel_pos_cache[1], self._rel_pos_cache[2]
+
+        Rh = get_rel_pos(q_size[0], k_size[0], self.rel_pos_h)
+        Rw = get_rel_pos(q_size[1], k_size[1], self.rel_pos_w)
+        if use_cache:
+            self._rel_pos_cache = (key, Rh, Rw)
+        return Rh, Rw
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         B, H, W, _ = x.shape
         # qkv with shape (3, B, nHead, H * W, C)
@@ -228,17 +431,88 @@ class Attention(nn.Module):
         # q, k, v with shape (B * nHead, H * W, C)
         q, k, v = qkv.reshape(3, B * self.num_heads, H * W, -1).unbind(0)
 
-        attn = (q * self.scale) @ k.transpose(-2, -1)
-
+        rel_h, rel_w = None, None
         if self.use_rel_pos:
-            attn = add_decomposed_rel_pos(attn, q, self.rel_pos_h, self.rel_pos_w, (H, W), (H, W))
+            Rh, Rw = self.get_rel_pos_tables((H, W), (H, W))
+            rel_h, rel_w = get_decomposed_rel_pos(q, Rh, Rw, (H, W), (H, W))
+            # Flatten the query positions so the terms can be sliced with the queries
+            rel_h = rel_h.reshape(B * self.num_heads, H * W, H)
+            rel_w = rel_w.reshape(B * self.num_heads, H * W, W)
+
+        # Process the queries in chunks if the attention map would exceed the budget
+        bounds = [0, H * W]
+        if self.max_attn_bytes is not None:
+            row_bytes = B * self.num_heads * H * W * q.element_size()
+            # Matmuls with only a few query rows can take kernels that round
+            # differently, so chunks have at least min_chunk queries.
+            min_chunk = 64
+            chunk_size = max(min_chunk, self.max_attn_bytes // row_bytes)
+            bounds = list(range(0, H * W, chunk_size)) + [H * W]
+            if len(bounds) > 2 and bounds[-1] - bounds[-2] < min_chunk:
+                # Merge a short last chunk into the previous one
+                del bounds[-2]
+
+        x_chunks = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            x_chunks.append(
+                self._attend(
+                    q[:, start:end],
+                    k,
+                    v,
+                    rel_h[:, start:end] if rel_h is not None else None,
+                    rel_w[:, start:end] if rel_w is not None else None,
+                    B,
+                    (H, W),
+                )
+            )
+        x = torch.cat(x_chunks, dim=1) if len(x_chunks) > 1 else x_chunks[0]
 
-        attn = attn.softmax(dim=-1)
-        x = (attn @ v).view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
+        x = x.view(B, self.num_heads, H, W, -1).permute(0, 2, 3, 1, 4).reshape(B, H, W, -1)
         x = self.proj(x)
 
         return x
 
+    def _attend(
+        self,
+        q: torch.Tensor,
+        k: torch.Tensor,
+        v: torch.Tensor,
+        rel_h: Optional[torch.Tensor],
+        rel_w: Optional[torch.Tensor],
+        B: int,
+        k_size: Tuple[int, int],
+    ) -> torch.Tensor:
+        """
+        Attends a chunk of N queries with shape (B * nHead, N, C) to all keys,
+        adding the matching rows of the relative positional terms rel_h with shape
+        (B * nHead, N, k_h) and rel_w with shape (B * nHead, N, k_w).
+        """
+        k_h, k_w = k_size
+        n = q.shape[1]
+        if self.attn_impl == "sdpa":
+            attn_bias = None
+            if rel_h is not None and rel_w is not None:
+                attn_bias = (rel_h[:, :, :, None] + rel_w[:, :, None, :]).reshape(
+                    B, self.num_heads, n, k_h * k_w
+                )
+            x = F.scaled_dot_product_attention(
+                q.view(B, self.num_heads, n, -1),
+                k.view(B, self.num_heads, k_h * k_w, -1),
+                v.view(B, self.num_heads, k_h * k_w, -1),
+                attn_mask=attn_bias,
+            )
+            return x.reshape(B * self.num_heads, n, -1)
+
+        attn = (q * self.scale) @ k.transpose(-2, -1)
+
+        if rel_h is not None and rel_w is not None:
+            attn = (attn.view(-1, n, k_h, k_w) + rel_h[:, :, :, None] + rel_w[:, :, None, :]).view(
+                -1, n, k_h * k_w
+            )
+
+        attn = attn.softmax(dim=-1, dtype=torch.float32).to(v.dtype)
+        return attn @ v
+
 
 def window_partition(x: torch.Tensor, window_size: int) -> Tuple[torch.Tensor, Tuple[int, int]]:
     """
@@ -322,6 +596,35 @@ def get_rel_pos(q_size: int, k_size: int, rel_pos: torch.Tensor) -> torch.Tensor
     return rel_pos_resized[relative_coords.long()]
 
 
+def get_decomposed_rel_pos(
+    q: torch.Tensor,
+    Rh: torch.Tensor,
+    Rw: torch.Tensor,
+    q_size: Tuple[int, int],
+    k_size: Tuple[int, int],
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Calculate the height and width terms of the decomposed Relative Positional
+    Embeddings from :paper:`mvitv2`, without adding them to an attention map.
+    Args:
+        q (Tensor): query q in the attention layer with shape (B, q_h * q_w, C).
+        Rh (Tensor): relative position table (q_h, k_h, C) for height axis, from get_rel_pos.
+        Rw (Tensor): relative position table (q_w, k_w, C) for width axis, from get_rel_pos.
+        q_size (Tuple): spatial sequence size of query q with (q_h, q_w).
+        k_size (Tuple): spatial sequence size of key k with (k_h, k_w).
+
+    Returns:
+        rel_h (Tensor): height term with shape (B, q_h, q_w, k_h).
+        rel_w (Tensor): width term with shape (B, q_h, q_w, k_w).
+    """
+    q_h, q_w = q_size
+    B, _, dim = q.shape
+    r_q = q.reshape(B, q_h, q_w, dim)
+    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
+    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
+    return rel_h, rel_w
+
+
 def add_decomposed_rel_pos(
     attn: torch.Tensor,
     q: torch.Tensor,
@@ -348,12 +651,9 @@ def add_decomposed_rel_pos(
     k_h, k_w = k_size
     Rh = get_rel_pos(q_h, k_h, rel_pos_h)
     Rw = get_rel_pos(q_w, k_w, rel_pos_w)
+    rel_h, rel_w = get_decomposed_rel_pos(q, Rh, Rw, q_size, k_size)
 
-    B, _, dim = q.shape
-    r_q = q.reshape(B, q_h, q_w, dim)
-    rel_h = torch.einsum("bhwc,hkc->bhwk", r_q, Rh)
-    rel_w = torch.einsum("bhwc,wkc->bhwk", r_q, Rw)
-
+    B = q.shape[0]
     attn = (
         attn.view(B, q_h, q_w, k_h, k_w) + rel_h[:, :, :, :, None] + rel_w[:, :, :, None, :]
     ).view(B, q_h * q_w, k_h * k_w)
@@ -8,9 +8,9 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import List, Tuple, Type
+from typing import Dict, List, Optional, Tuple, Type, cast
 
-from .common import LayerNorm2d
+from .common import LayerNorm2d, inference_mode_enabled
 
 
 class MaskDecoder(nn.Module):
@@ -67,6 +67,9 @@ class MaskDecoder(nn.Module):
         self.iou_prediction_head = MLP(
             transformer_dim, iou_head_hidden_dim, self.num_mask_tokens, iou_head_depth
         )
+        self._hypernetwork_cache: Dict[
+            Tuple, Tuple[Tuple, List[Tuple[torch.Tensor, torch.Tensor]]]
+        ] = {}
 
     def forward(
         self,
@@ -75,6 +78,7 @@ class MaskDecoder(nn.Module):
         sparse_prompt_embeddings: torch.Tensor,
         dense_prompt_embeddings: torch.Tensor,
         multimask_output: bool,
+        image_indices: Optional[torch.Tensor] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Predict masks given image and prompt embeddings.
@@ -86,24 +90,30 @@ class MaskDecoder(nn.Module):
           dense_prompt_embeddings (torch.Tensor): the embeddings of the mask inputs
           multimask_output (bool): Whether to return multiple masks or a single
             mask.
+          image_indices (torch.Tensor or None): To decode the prompts of
+            several images in one call, image_embeddings holds the stacked
+            embeddings of all images and this gives the index of each prompt's
+            image, with shape B. If None, the single image in image_embeddings
+            is used for all prompts.
 
         Returns:
           torch.Tensor: batched predicted masks
           torch.Tensor: batched predictions of mask quality
         """
+        # Select the correct mask or masks for output. Only the selected masks
+        # are predicted.
+        if multimask_output:
+            mask_slice = slice(1, None)
+        else:
+            mask_slice = slice(0, 1)
         masks, iou_pred = self.predict_masks(
             image_embeddings=image_embeddings,
             image_pe=image_pe,
             sparse_prompt_embeddings=sparse_prompt_embeddings,
             dense_prompt_embeddings=dense_prompt_embeddings,
+            image_indices=image_indices,
+            mask_slice=mask_slice,
         )
-
-        # Select the correct mask or masks for output
-        if multimask_output:
-            mask_slice = slice(1, None)
-        else:
-            mask_slice = slice(0, 1)
-        masks = masks[:, mask_slice, :, :]
         iou_pred = iou_pred[:, mask_slice]
 
         # Prepare output
@@ -115,18 +125,38 @@ class MaskDecoder(nn.Module):
         image_pe: torch.Tensor,
         sparse_prompt_embeddings: torch.Tensor,
         dense_prompt_embeddings: torch.Tensor,
+        image_indices: Optional[torch.Tensor] = None,
+        mask_slice: slice = slice(None),
     ) -> Tuple[torch.Tensor, torch.Tensor]:
-        """Predicts masks. See 'forward' for more details."""
+        """
+        Predicts masks. See 'forward' for more details. Only the masks of the
+        mask tokens in mask_slice are predicted, while mask quality is always
+        predicted for all mask tokens.
+        """
         # Concatenate output tokens
         output_tokens = torch.cat([self.iou_token.weight, self.mask_tokens.weight], dim=0)
         output_tokens = output_tokens.unsqueeze(0).expand(sparse_prompt_embeddings.size(0), -1, -1)
         tokens = torch.cat((output_tokens, sparse_prompt_embeddings), dim=1)
 
-        # Expand per-image data in batch direction to be per-mask
-        src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
-        src = src + dense_prompt_embeddings
-        pos_src = torch.repeat_interleave(image_pe, tokens.shape[0], dim=0)
-        b, c, h, w = src.shape
+        # Expand per-image data in batch direction to be per-mask. When all
+        # prompts share one image and one dense embedding, as with the no-mask
+        # embedding that PromptEncoder expands over the batch, the image tokens
+        # stay at batch size 1 and are broadcast inside the transformer, which
+        # only makes them per-prompt after the first image-to-token attention.
+        # The positional encoding is always broadcast.
+        shared_dense = (
+            dense_prompt_embeddings.shape[0] == 1 or dense_prompt_embeddings.stride(0) == 0
+        )
+        if image_indices is None and image_embeddings.shape[0] == 1 and shared_dense:
+            src = image_embeddings + dense_prompt_embeddings[:1]
+        elif image_indices is None:
+            src = torch.repeat_interleave(image_embeddings, tokens.shape[0], dim=0)
+            src = src + dense_prompt_embeddings
+        else:
+            src = image_embeddings[image_indices] + dense_prompt_embeddings
+        pos_src = image_pe
+        b = tokens.shape[0]
+        _, c, h, w = src.shape
 
         # Run the transformer
         hs, src = self.transformer(src, pos_src, tokens)
@@ -136,10 +166,7 @@ class MaskDecoder(nn.Module):
         # Upscale mask embeddings and predict masks using the mask tokens
         src = src.transpose(1, 2).view(b, c, h, w)
         upscaled_embedding = self.output_upscaling(src)
-        hyper_in_list: List[torch.Tensor] = []
-        for i in range(self.num_mask_tokens):
-            hyper_in_list.append(self.output_hypernetworks_mlps[i](mask_tokens_out[:, i, :]))
-        hyper_in = torch.stack(hyper_in_list, dim=1)
+        hyper_in = self._run_hypernetworks(mask_tokens_out[:, mask_slice, :], mask_slice)
         b, c, h, w = upscaled_embedding.shape
         masks = (hyper_in @ upscaled_embedding.view(b, c, h * w)).view(b, -1, h, w)
 
@@ -148,6 +175,53 @@ class MaskDecoder(nn.Module):
 
         return masks, iou_pred
 
+    def _run_hypernetworks(self, mask_tokens_out: torch.Tensor, mask_slice: slice) -> torch.Tensor:
+        """
+        Applies the hypernetwork MLP of each mask token in mask_slice to its
+        output, with one batched matmul per layer over all tokens instead of
+        one MLP call per token.
+        """
+        layers = self._get_hypernetwork_layers(mask_slice)
+        x = mask_tokens_out.transpose(0, 1)  # N_tokens x B x C
+        for i, (weight, bias) in enumerate(layers):
+            x = torch.baddbmm(bias, x, weight)
+            if i < len(layers) - 1:
+                x = F.relu(x)
+        return x.transpose(0, 1)  # B x N_tokens x C
+
+    def _get_hypernetwork_layers(
+        self, mask_slice: slice
+    ) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Returns, per layer, the weights with shape N_tokens x C_in x C_out and
+        the biases with shape N_tokens x 1 x C_out of the hypernetwork MLPs of
+        the mask tokens in mask_slice, stacked. Without grad, they are reused
+        until the MLPs' parameters are moved, replaced or updated in place.
+        """
+        mlps = cast(List[MLP], list(self.output_hypernetworks_mlps)[mask_slice])
+        linears = [cast(List[nn.Linear], list(mlp.layers)) for mlp in mlps]
+        use_cache = not torch.is_grad_enabled()
+        if use_cache:
+            slice_key = (mask_slice.start, mask_slice.stop, mask_slice.step)
+            key = (inference_mode_enabled(),) + tuple(
+                (p.data_ptr(), p._version)
+                for mlp_linears in linears
+                for linear in mlp_linears
+                for p in (linear.weight, linear.bias)
+            )
+            cached = self._hypernetwork_cache.get(slice_key)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+
+        layers = []
+        for i in range(len(linears[0])):
+            weight = torch.stack([mlp_linears[i].weight for mlp_linears in linears])
+            bias = torch.stack([mlp_linears[i].bias for mlp_linears in linears])
+            layers.append((weight.transpose(1, 2), bias.unsqueeze(1)))
+        if use_cache:
+            self._hypernetwork_cache[slice_key] = (key, layers)
+        return layers
+
 
 # Lightly adapted from
 # https://github.com/facebookresearch/MaskFormer/blob/main/mask_former/modeling/transformer/transformer_predictor.py # noqa
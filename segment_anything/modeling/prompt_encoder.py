@@ -8,9 +8,10 @@ import numpy as np
 import torch
 from torch import nn
 
-from typing import Any, Optional, Tuple, Type
+from contextlib import nullcontext
+from typing import Any, ContextManager, Optional, Tuple, Type
 
-from .common import LayerNorm2d
+from .common import LayerNorm2d, inference_mode_enabled
 
 
 class PromptEncoder(nn.Module):
@@ -58,17 +59,35 @@ class PromptEncoder(nn.Module):
             nn.Conv2d(mask_in_chans, embed_dim, kernel_size=1),
         )
         self.no_mask_embed = nn.Embedding(1, embed_dim)
+        self._dense_pe_cache: Optional[Tuple[Tuple, torch.Tensor]] = None
 
     def get_dense_pe(self) -> torch.Tensor:
         """
         Returns the positional encoding used to encode point prompts,
         applied to a dense set of points the shape of the image encoding.
+        It does not depend on the image or prompts, so it is computed once
+        and reused until the model is moved or its encoding matrix changes.
 
         Returns:
           torch.Tensor: Positional encoding with shape
             1x(embed_dim)x(embedding_h)x(embedding_w)
         """
-        return self.pe_layer(self.image_embedding_size).unsqueeze(0)
+        if torch.jit.is_tracing() or torch.jit.is_scripting():
+            return self.pe_layer(self.image_embedding_size).unsqueeze(0)
+        # The key changes if the encoding matrix is moved or replaced (data_ptr),
+        # or if it is updated in place (_version). Tensors created in inference
+        # mode can't be used outside of it, so the mode is part of the key.
+        matrix = self.pe_layer.positional_encoding_gaussian_matrix
+        key = (
+            self.image_embedding_size,
+            matrix.data_ptr(),
+            matrix._version,
+            inference_mode_enabled(),
+        )
+        if self._dense_pe_cache is None or self._dense_pe_cache[0] != key:
+            dense_pe = self.pe_layer(self.image_embedding_size).unsqueeze(0)
+            self._dense_pe_cache = (key, dense_pe)
+        return self._dense_pe_cache[1]
 
     def _embed_points(
         self,
@@ -173,6 +192,8 @@ class PositionEmbeddingRandom(nn.Module):
     Positional encoding using random spatial frequencies.
     """
 
+    positional_encoding_gaussian_matrix: torch.Tensor
+
     def __init__(self, num_pos_feats: int = 64, scale: Optional[float] = None) -> None:
         super().__init__()
         if scale is None or scale <= 0.0:
@@ -186,7 +207,9 @@ class PositionEmbeddingRandom(nn.Module):
         """Positionally encode points that are normalized to [0,1]."""
         # assuming coords are in [0, 1]^2 square and have d_1 x ... x d_n x 2 shape
         coords = 2 * coords - 1
-        coords = coords @ self.positional_encoding_gaussian_matrix
+        # The sin/cos arguments need fp32 precision, so this stays out of autocast
+        with _disable_autocast(coords.device.type):
+            coords = coords.float() @ self.positional_encoding_gaussian_matrix.float()
         coords = 2 * np.pi * coords
         # outputs d_1 x ... x d_n x C shape
         return torch.cat([torch.sin(coords), torch.cos(coords)], dim=-1)
@@ -212,3 +235,23 @@ class PositionEmbeddingRandom(nn.Module):
         coords[:, :, 0] = coords[:, :, 0] / image_size[1]
         coords[:, :, 1] = coords[:, :, 1] / image_size[0]
         return self._pe_encoding(coords.to(torch.float))  # B x N x C
+
+
+def _disable_autocast(device_type: str) -> ContextManager:
+    """
+    Returns a context that disables autocast on device_type if it is enabled,
+    and a no-op context otherwise, so the default fp32 path doesn't need
+    torch.autocast, which was added in torch 1.10.
+    """
+    if not hasattr(torch, "autocast"):
+        return nullcontext()
+    try:
+        enabled = torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # Before torch 2.4, is_autocast_enabled takes no device and reports CUDA
+        enabled = (
+            torch.is_autocast_cpu_enabled() if device_type == "cpu" else torch.is_autocast_enabled()
+        )
+    if not enabled:
+        return nullcontext()
+    return torch.autocast(device_type=device_type, enabled=False)
@@ -8,16 +8,224 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 
-from typing import Any, Dict, List, Tuple
+from contextlib import nullcontext
+from typing import Any, ContextManager, Dict, List, Optional, Tuple
 
 from .image_encoder import ImageEncoderViT
 from .mask_decoder import MaskDecoder
 from .prompt_encoder import PromptEncoder
 
 
-class Sam(nn.Module):
+class SamPromptDecoder(nn.Module):
     mask_threshold: float = 0.0
+
+    def __init__(
+        self,
+        prompt_encoder: PromptEncoder,
+        mask_decoder: MaskDecoder,
+        img_size: int = 1024,
+    ) -> None:
+        """
+        The prompt side of SAM: predicts object masks from precomputed image
+        embeddings and input prompts, without an image encoder. Sam extends
+        it with the image encoder.
+
+        Arguments:
+          prompt_encoder (PromptEncoder): Encodes various types of input prompts.
+          mask_decoder (MaskDecoder): Predicts masks from the image embeddings
+            and encoded prompts.
+          img_size (int): The input size of the image encoder the image
+            embeddings were computed with.
+        """
+        super().__init__()
+        self.prompt_encoder = prompt_encoder
+        self.mask_decoder = mask_decoder
+        self.img_size = img_size
+
+    @property
+    def device(self) -> Any:
+        return self.prompt_encoder.pe_layer.positional_encoding_gaussian_matrix.device
+
+    def autocast(self, precision: str = "fp32") -> ContextManager:
+        """
+        Returns a context manager that runs the model calls inside it at the
+        given precision.
+
+        Arguments:
+          precision (str): 'fp32' runs the model as is. 'bf16' runs the matmul
+            and convolution heavy layers under bfloat16 autocast on the model's
+            device. LayerNorm2d, softmax and the positional encoding are still
+            computed in fp32.
+
+        Returns:
+          (ContextManager): The autocast context.
+        """
+        assert precision in ["fp32", "bf16"], f"Unknown precision {precision}."
+        if precision == "fp32":
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+
+    def postprocess_masks(
+        self,
+        masks: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+    ) -> torch.Tensor:
+        """
+        Remove padding and upscale masks to the original image size.
+
+        Arguments:
+          masks (torch.Tensor): Batched masks from the mask_decoder,
+            in BxCxHxW format.
+          input_size (tuple(int, int)): The size of the image input to the
+            model, in (H, W) format. Used to remove padding.
+          original_size (tuple(int, int)): The original size of the image
+            before resizing for input to the model, in (H, W) format.
+
+        Returns:
+          (torch.Tensor): Batched masks in BxCxHxW format, where (H, W)
+            is given by original_size. Always upscaled in fp32.
+        """
+        masks = F.interpolate(
+            masks.float(),
+            (self.img_size, self.img_size),
+            mode="bilinear",
+            align_corners=False,
+        )
+        masks = masks[..., : input_size[0], : input_size[1]]
+        masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
+        return masks
+
+    def postprocess_masks_roi(
+        self,
+        masks: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
+        boxes: Optional[torch.Tensor] = None,
+    ) -> Tuple[List[torch.Tensor], torch.Tensor]:
+        """
+        Like 'postprocess_masks', but only computes the masks of each prompt
+        inside a region of the original image, so that time and memory grow
+        with the size of the object rather than the size of the image. Each
+        output pixel is gathered from the low resolution masks with the same
+        bilinear weights as the two upscaling steps of 'postprocess_masks',
+        so the crops equal the matching region of its output up to float
+        rounding.
+
+        Arguments:
+          masks (torch.Tensor): Batched masks from the mask_decoder,
+            in BxCxHxW format.
+          input_size (tuple(int, int)): The size of the image input to the
+            model, in (H, W) format.
+          original_size (tuple(int, int)): The original size of the image
+            before resizing for input to the model, in (H, W) format.
+          boxes (torch.Tensor or None): The region of each prompt as a Bx4
+            array in XYXY format, in pixels of the original image. If None,
+            the region is the smallest one outside of which all C upscaled
+            masks of the prompt are at most mask_threshold, found from the
+            low resolution masks.
+
+        Returns:
+          (list(torch.Tensor)): For each prompt, its masks inside its region
+            in Cxhxw format. Always computed in fp32.
+          (torch.Tensor): The region of each prompt as a Bx4 int64 array in
+            XYXY format, in pixels of the original image. (x0, y0) is the
+            offset of the crop in the full mask.
+        """
+        masks = masks.float()
+        b, _, low_res_h, low_res_w = masks.shape
+        idx_y, weight_y = self._upscaling_weights(
+            low_res_h, input_size[0], original_size[0], masks.device
+        )
+        idx_x, weight_x = self._upscaling_weights(
+            low_res_w, input_size[1], original_size[1], masks.device
+        )
+
+        if boxes is None:
+            boxes = self._masks_to_roi_boxes(masks, idx_y, idx_x)
+        else:
+            boxes = (
+                torch.stack([boxes[:, :2].floor(), boxes[:, 2:].ceil()], dim=1).flatten(1).long()
+            )
+            boxes[:, 0::2] = boxes[:, 0::2].clamp(0, original_size[1])
+            boxes[:, 1::2] = boxes[:, 1::2].clamp(0, original_size[0])
+            boxes[:, 2:] = torch.maximum(boxes[:, 2:], boxes[:, :2])
+
+        # The first and last low res pixel each output pixel is computed from
+        bounds_y = idx_y[:, [0, -1]].tolist()
+        bounds_x = idx_x[:, [0, -1]].tolist()
+        crops = []
+        for i, (x0, y0, x1, y1) in enumerate(boxes.tolist()):
+            if x1 == x0 or y1 == y0:
+                crops.append(masks.new_zeros((masks.shape[1], y1 - y0, x1 - x0)))
+                continue
+            # Only gather from the low res pixels the region is computed from
+            low_y0, low_y1 = bounds_y[y0][0], bounds_y[y1 - 1][1] + 1
+            low_x0, low_x1 = bounds_x[x0][0], bounds_x[x1 - 1][1] + 1
+            low_res = masks[i, :, low_y0:low_y1, low_x0:low_x1]
+            # Upscale rows, then columns, each as a weighted gather of low res pixels
+            rows = low_res[:, idx_y[y0:y1] - low_y0]  # C x h x 4 x w_low_res
+            rows = (rows * weight_y[y0:y1, :, None]).sum(dim=2)
+            crop = rows[:, :, idx_x[x0:x1] - low_x0]  # C x h x w x 4
+            crops.append((crop * weight_x[x0:x1]).sum(dim=-1))
+        return crops, boxes
+
+    def _upscaling_weights(
+        self, low_res_size: int, input_size: int, original_size: int, device: torch.device
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Composes the two bilinear resizes of 'postprocess_masks' along one
+        axis: from low_res_size to img_size, cropped to input_size, then to
+        original_size. Returns, for each output pixel, the indices of the low
+        resolution pixels it is computed from and their weights, both with
+        shape original_size x 4.
+        """
+
+        def linear_weights(in_size: int, out_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+            # Source coordinates of bilinear interpolation with align_corners=False
+            scale = in_size / out_size
+            src = ((torch.arange(out_size, device=device) + 0.5) * scale - 0.5).clamp(min=0)
+            idx0 = src.long().clamp(max=in_size - 1)
+            idx1 = (idx0 + 1).clamp(max=in_size - 1)
+            lambda1 = src - idx0
+            return torch.stack([idx0, idx1], dim=1), torch.stack([1 - lambda1, lambda1], dim=1)
+
+        # Low res -> padded model input, of which only the first input_size pixels are kept
+        idx_padded, weight_padded = linear_weights(low_res_size, self.img_size)
+        idx_padded, weight_padded = idx_padded[:input_size], weight_padded[:input_size]
+        # Cropped model input -> original image
+        idx, weight = linear_weights(input_size, original_size)
+        weight = weight[:, :, None] * weight_padded[idx]
+        return idx_padded[idx].flatten(1), weight.flatten(1)
+
+    def _masks_to_roi_boxes(
+        self, masks: torch.Tensor, idx_y: torch.Tensor, idx_x: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        Finds, for each prompt, the box of original image pixels that any low
+        resolution pixel above mask_threshold contributes to. Outside of it
+        all upscaled masks of the prompt are at most mask_threshold, since
+        each upscaled pixel is a convex combination of low resolution pixels.
+        """
+        foreground = (masks > self.mask_threshold).any(dim=1)
+        boxes = []
+        for dim, idx in [(1, idx_x), (2, idx_y)]:
+            in_mask = foreground.any(dim=dim)  # B x low res size
+            positions = torch.arange(in_mask.shape[1], device=masks.device)
+            first = torch.where(in_mask, positions, in_mask.shape[1]).amin(dim=1)
+            last = torch.where(in_mask, positions, -1).amax(dim=1)
+            # The low res indices used by each output pixel are nondecreasing along the axis
+            start = torch.searchsorted(idx.amax(dim=1).contiguous(), first)
+            end = torch.searchsorted(idx.amin(dim=1).contiguous(), last, right=True)
+            boxes.append((start, torch.maximum(end, start)))
+        (x0, x1), (y0, y1) = boxes
+        return torch.stack([x0, y0, x1, y1], dim=1)
+
+
+class Sam(SamPromptDecoder):
     image_format: str = "RGB"
+    pixel_mean: torch.Tensor
+    pixel_std: torch.Tensor
 
     def __init__(
         self,
@@ -39,10 +247,8 @@ class Sam(nn.Module):
           pixel_mean (list(float)): Mean values for normalizing pixels in the input image.
           pixel_std (list(float)): Std values for normalizing pixels in the input image.
         """
-        super().__init__()
+        super().__init__(prompt_encoder, mask_decoder, img_size=image_encoder.img_size)
         self.image_encoder = image_encoder
-        self.prompt_encoder = prompt_encoder
-        self.mask_decoder = mask_decoder
         self.register_buffer("pixel_mean", torch.Tensor(pixel_mean).view(-1, 1, 1), False)
         self.register_buffer("pixel_std", torch.Tensor(pixel_std).view(-1, 1, 1), False)
 
@@ -50,11 +256,24 @@ class Sam(nn.Module):
     def device(self) -> Any:
         return self.pixel_mean.device
 
+    def encoder_autocast(self, precision: str = "fp32") -> ContextManager:
+        """
+        Like autocast, for calls of the image encoder. Dynamically quantized
+        int8 linear layers only accept fp32 inputs, so an encoder built with
+        quantize_encoder always runs in fp32, and 'bf16' then only applies to
+        the prompt encoder and mask decoder.
+        """
+        if _is_quantized(self.image_encoder):
+            assert precision in ["fp32", "bf16"], f"Unknown precision {precision}."
+            return nullcontext()
+        return self.autocast(precision)
+
     @torch.no_grad()
     def forward(
         self,
         batched_input: List[Dict[str, Any]],
         multimask_output: bool,
+        precision: str = "fp32",
     ) -> List[Dict[str, torch.Tensor]]:
         """
         Predicts masks end-to-end from provided images and prompts.
@@ -80,6 +299,10 @@ class Sam(nn.Module):
                 in the form Bx1xHxW.
           multimask_output (bool): Whether the model should predict multiple
             disambiguating masks, or return a single mask.
+          precision (str): The precision to run the image encoder and mask
+            decoder at, 'fp32' or 'bf16'. See Sam.autocast. Outputs are
+            always fp32. A quantized image encoder always runs in fp32, see
+            Sam.encoder_autocast.
 
         Returns:
           (list(dict)): A list over input images, where each element is
@@ -95,7 +318,10 @@ class Sam(nn.Module):
                 to subsequent iterations of prediction.
         """
         input_images = torch.stack([self.preprocess(x["image"]) for x in batched_input], dim=0)
-        image_embeddings = self.image_encoder(input_images)
+        with self.encoder_autocast(precision):
+            image_embeddings = self.image_encoder(
+                input_images, input_sizes=[tuple(x["image"].shape[-2:]) for x in batched_input]
+            )
 
         outputs = []
         for image_record, curr_embedding in zip(batched_input, image_embeddings):
@@ -103,18 +329,20 @@ class Sam(nn.Module):
                 points = (image_record["point_coords"], image_record["point_labels"])
             else:
                 points = None
-            sparse_embeddings, dense_embeddings = self.prompt_encoder(
-                points=points,
-                boxes=image_record.get("boxes", None),
-                masks=image_record.get("mask_inputs", None),
-            )
-            low_res_masks, iou_predictions = self.mask_decoder(
-                image_embeddings=curr_embedding.unsqueeze(0),
-                image_pe=self.prompt_encoder.get_dense_pe(),
-                sparse_prompt_embeddings=sparse_embeddings,
-                dense_prompt_embeddings=dense_embeddings,
-                multimask_output=multimask_output,
-            )
+            with self.autocast(precision):
+                sparse_embeddings, dense_embeddings = self.prompt_encoder(
+                    points=points,
+                    boxes=image_record.get("boxes", None),
+                    masks=image_record.get("mask_inputs", None),
+                )
+                low_res_masks, iou_predictions = self.mask_decoder(
+                    image_embeddings=curr_embedding.unsqueeze(0),
+                    image_pe=self.prompt_encoder.get_dense_pe(),
+                    sparse_prompt_embeddings=sparse_embeddings,
+                    dense_prompt_embeddings=dense_embeddings,
+                    multimask_output=multimask_output,
+                )
+            low_res_masks, iou_predictions = low_res_masks.float(), iou_predictions.float()
             masks = self.postprocess_masks(
                 low_res_masks,
                 input_size=image_record["image"].shape[-2:],
@@ -130,37 +358,6 @@ class Sam(nn.Module):
             )
         return outputs
 
-    def postprocess_masks(
-        self,
-        masks: torch.Tensor,
-        input_size: Tuple[int, ...],
-        original_size: Tuple[int, ...],
-    ) -> torch.Tensor:
-        """
-        Remove padding and upscale masks to the original image size.
-
-        Arguments:
-          masks (torch.Tensor): Batched masks from the mask_decoder,
-            in BxCxHxW format.
-          input_size (tuple(int, int)): The size of the image input to the
-            model, in (H, W) format. Used to remove padding.
-          original_size (tuple(int, int)): The original size of the image
-            before resizing for input to the model, in (H, W) format.
-
-        Returns:
-          (torch.Tensor): Batched masks in BxCxHxW format, where (H, W)
-            is given by original_size.
-        """
-        masks = F.interpolate(
-            masks,
-            (self.image_encoder.img_size, self.image_encoder.img_size),
-            mode="bilinear",
-            align_corners=False,
-        )
-        masks = masks[..., : input_size[0], : input_size[1]]
-        masks = F.interpolate(masks, original_size, mode="bilinear", align_corners=False)
-        return masks
-
     def preprocess(self, x: torch.Tensor) -> torch.Tensor:
         """Normalize pixel values and pad to a square input."""
         # Normalize colors
@@ -168,7 +365,41 @@ class Sam(nn.Module):
 
         # Pad
         h, w = x.shape[-2:]
-        padh = self.image_encoder.img_size - h
-        padw = self.image_encoder.img_size - w
+        padh = self.img_size - h
+        padw = self.img_size - w
         x = F.pad(x, (0, padw, 0, padh))
         return x
+
+    def preprocess_into(
+        self, x: torch.Tensor, out: torch.Tensor, flip_channels: bool = False
+    ) -> torch.Tensor:
+        """
+        Normalizes pixel values and pads to a square input like 'preprocess',
+        but writes the result into a preallocated tensor instead of
+        allocating intermediate ones.
+
+        Arguments:
+          x (torch.Tensor): The image in 1x3xHxW format, of any dtype and on
+            any device, as returned by ResizeLongestSide.apply_image_uint8_torch.
+          out (torch.Tensor): The float tensor to write to, with shape
+            3 x img_size x img_size, on the model's device.
+          flip_channels (bool): If true, the channel order is reversed while
+            writing, which converts between BGR and RGB without a copy.
+
+        Returns:
+          (torch.Tensor): out.
+        """
+        h, w = x.shape[-2:]
+        x = x[0].to(out.device)
+        out[:, h:, :].zero_()
+        out[:, :h, w:].zero_()
+        image = out[:, :h, :w]
+        for c in range(3):
+            image[c].copy_(x[2 - c if flip_channels else c])
+        image.sub_(self.pixel_mean).div_(self.pixel_std)
+        return out
+
+
+def _is_quantized(module: nn.Module) -> bool:
+    """Whether module contains dynamically quantized linear layers."""
+    return any(isinstance(m, torch.nn.quantized.dynamic.Linear) for m in module.modules())
@@ -6,6 +6,7 @@
 
 import torch
 from torch import Tensor, nn
+from torch.nn import functional as F
 
 import math
 from typing import Tuple, Type
@@ -22,6 +23,7 @@ class TwoWayTransformer(nn.Module):
         mlp_dim: int,
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
+        attn_impl: str = "eager",
     ) -> None:
         """
         A transformer decoder that attends to an input image using
@@ -34,6 +36,8 @@ class TwoWayTransformer(nn.Module):
             divide embedding_dim
           mlp_dim (int): the channel dimension internal to the MLP block
           activation (nn.Module): the activation to use in the MLP block
+          attn_impl (str): the attention backend of all attention layers, in
+            ['eager', 'sdpa']. See Attention.
         """
         super().__init__()
         self.depth = depth
@@ -51,11 +55,12 @@ class TwoWayTransformer(nn.Module):
                     activation=activation,
                     attention_downsample_rate=attention_downsample_rate,
                     skip_first_layer_pe=(i == 0),
+                    attn_impl=attn_impl,
                 )
             )
 
         self.final_attn_token_to_image = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate
+            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, attn_impl=attn_impl
         )
         self.norm_final_attn = nn.LayerNorm(embedding_dim)
 
@@ -68,9 +73,12 @@ class TwoWayTransformer(nn.Module):
         """
         Args:
           image_embedding (torch.Tensor): image to attend to. Should be shape
-            B x embedding_dim x h x w for any h and w.
+            B x embedding_dim x h x w for any h and w, or 1 x embedding_dim x h x w
+            to share one image between all B queries. A shared image is
+            broadcast, so its keys and values in the first block are projected
+            once rather than once per query.
           image_pe (torch.Tensor): the positional encoding to add to the image. Must
-            have the same shape as image_embedding.
+            have the same shape as image_embedding, or batch size 1.
           point_embedding (torch.Tensor): the embedding to add to the query points.
             Must have shape B x N_points x embedding_dim for any N_points.
 
@@ -115,6 +123,7 @@ class TwoWayAttentionBlock(nn.Module):
         activation: Type[nn.Module] = nn.ReLU,
         attention_downsample_rate: int = 2,
         skip_first_layer_pe: bool = False,
+        attn_impl: str = "eager",
     ) -> None:
         """
         A transformer block with four layers: (1) self-attention of sparse
@@ -128,13 +137,14 @@ class TwoWayAttentionBlock(nn.Module):
           mlp_dim (int): the hidden dimension of the mlp block
           activation (nn.Module): the activation of the mlp block
           skip_first_layer_pe (bool): skip the PE on the first layer
+          attn_impl (str): the attention backend, in ['eager', 'sdpa']
         """
         super().__init__()
-        self.self_attn = Attention(embedding_dim, num_heads)
+        self.self_attn = Attention(embedding_dim, num_heads, attn_impl=attn_impl)
         self.norm1 = nn.LayerNorm(embedding_dim)
 
         self.cross_attn_token_to_image = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate
+            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, attn_impl=attn_impl
         )
         self.norm2 = nn.LayerNorm(embedding_dim)
 
@@ -143,7 +153,7 @@ class TwoWayAttentionBlock(nn.Module):
 
         self.norm4 = nn.LayerNorm(embedding_dim)
         self.cross_attn_image_to_token = Attention(
-            embedding_dim, num_heads, downsample_rate=attention_downsample_rate
+            embedding_dim, num_heads, downsample_rate=attention_downsample_rate, attn_impl=attn_impl
         )
 
         self.skip_first_layer_pe = skip_first_layer_pe
@@ -186,6 +196,11 @@ class Attention(nn.Module):
     """
     An attention layer that allows for downscaling the size of the embedding
     after projection to queries, keys, and values.
+
+    With attn_impl='eager' the attention map is computed explicitly. With
+    'sdpa' torch's fused scaled_dot_product_attention is used instead, which
+    computes the same softmax attention without materializing the
+    N_queries x N_keys attention map for every prompt.
     """
 
     def __init__(
@@ -193,8 +208,15 @@ class Attention(nn.Module):
         embedding_dim: int,
         num_heads: int,
         downsample_rate: int = 1,
+        attn_impl: str = "eager",
     ) -> None:
         super().__init__()
+        assert attn_impl in ["eager", "sdpa"], f"Unknown attn_impl {attn_impl}."
+        if attn_impl == "sdpa":
+            assert hasattr(
+                F, "scaled_dot_product_attention"
+            ), "attn_impl='sdpa' requires torch>=2.0."
+        self.attn_impl = attn_impl
         self.embedding_dim = embedding_dim
         self.internal_dim = embedding_dim // downsample_rate
         self.num_heads = num_heads
@@ -227,10 +249,20 @@ class Attention(nn.Module):
         v = self._separate_heads(v, self.num_heads)
 
         # Attention
+        if self.attn_impl == "sdpa":
+            # A shared image has batch size 1; broadcast it explicitly since not
+            # every fused kernel broadcasts over the batch dimension
+            b = max(q.shape[0], k.shape[0])
+            out = F.scaled_dot_product_attention(
+                q.expand(b, -1, -1, -1), k.expand(b, -1, -1, -1), v.expand(b, -1, -1, -1)
+            )
+            out = self._recombine_heads(out)
+            return self.out_proj(out)
+
         _, _, _, c_per_head = q.shape
         attn = q @ k.permute(0, 1, 3, 2)  # B x N_heads x N_tokens x N_tokens
         attn = attn / math.sqrt(c_per_head)
-        attn = torch.softmax(attn, dim=-1)
+        attn = torch.softmax(attn, dim=-1, dtype=torch.float32).to(v.dtype)
 
         # Get output
         out = attn @ v
@@ -7,87 +7,175 @@
 import numpy as np
 import torch
 
-from segment_anything.modeling import Sam
+from segment_anything.modeling import Sam, SamPromptDecoder
 
-from typing import Optional, Tuple
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
 
+from .utils.amg import mask_to_rle_pytorch
+from .utils.io import atomic_write
 from .utils.transforms import ResizeLongestSide
 
 
-class SamPredictor:
+class ImageEmbedding:
+    """
+    The image embedding of a single image, together with the sizes needed
+    to predict masks for it. Returned by SamPredictor.encode_batch and
+    accepted by SamPredictor.predict and SamPredictor.predict_torch.
+    """
+
     def __init__(
         self,
-        sam_model: Sam,
+        features: torch.Tensor,
+        input_size: Tuple[int, ...],
+        original_size: Tuple[int, ...],
     ) -> None:
         """
-        Uses SAM to calculate the image embedding for an image, and then
-        allow repeated, efficient mask prediction given prompts.
-
         Arguments:
-          sam_model (Sam): The model to use for mask prediction.
+          features (torch.Tensor): The image embedding, with shape 1xCxHxW.
+          input_size (tuple(int, int)): The size of the image after
+            ResizeLongestSide, in (H, W) format.
+          original_size (tuple(int, int)): The size of the image before
+            transformation, in (H, W) format.
         """
-        super().__init__()
-        self.model = sam_model
-        self.transform = ResizeLongestSide(sam_model.image_encoder.img_size)
-        self.reset_image()
+        self.features = features
+        self.input_size = input_size
+        self.original_size = original_size
 
-    def set_image(
+    def to(self, device: torch.device) -> "ImageEmbedding":
+        """Returns the embedding with its features on device, or itself if already there."""
+        if self.features.device == torch.device(device):
+            return self
+        return ImageEmbedding(self.features.to(device), self.input_size, self.original_size)
+
+
+class EmbeddingCache:
+    def __init__(
         self,
-        image: np.ndarray,
-        image_format: str = "RGB",
+        max_bytes: int = 2**30,
+        cache_dir: Optional[str] = None,
     ) -> None:
         """
-        Calculates the image embeddings for the provided image, allowing
-        masks to be predicted with the 'predict' method.
+        A content-addressed cache of image embeddings for SamPredictor.
+        Embeddings are keyed by a hash of the image bytes and the identity of
+        the model, and kept in memory with least-recently-used eviction under
+        a byte budget. With cache_dir, every embedding is also written to disk,
+        so embeddings evicted from memory, or computed by another process, are
+        loaded instead of recomputed. The cache is safe to share between
+        predictors and threads.
 
         Arguments:
-          image (np.ndarray): The image for calculating masks. Expects an
-            image in HWC uint8 format, with pixel values in [0, 255].
-          image_format (str): The color format of the image, in ['RGB', 'BGR'].
+          max_bytes (int): The budget for the features held in memory.
+          cache_dir (str or None): If set, the folder of the on-disk tier.
+            It is not size limited.
         """
-        assert image_format in [
-            "RGB",
-            "BGR",
-        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
-        if image_format != self.model.image_format:
-            image = image[..., ::-1]
-
-        # Transform the image to the form expected by the model
-        input_image = self.transform.apply_image(image)
-        input_image_torch = torch.as_tensor(input_image, device=self.device)
-        input_image_torch = input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
-
-        self.set_torch_image(input_image_torch, image.shape[:2])
-
-    @torch.no_grad()
-    def set_torch_image(
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.num_bytes = 0
+        self._entries: "OrderedDict[str, ImageEmbedding]" = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, key: str) -> Optional[ImageEmbedding]:
+        """Returns the embedding for key, or None if it is not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        entry = torch.load(self._path(key))
+        embedding = ImageEmbedding(
+            entry["features"], tuple(entry["input_size"]), tuple(entry["original_size"])
+        )
+        self._insert(key, embedding)
+        return embedding
+
+    def put(self, key: str, embedding: ImageEmbedding) -> None:
+        """Adds an embedding to the cache, evicting the least recently used ones."""
+        self._insert(key, embedding)
+        if self.cache_dir is not None and not os.path.exists(self._path(key)):
+            entry = {
+                "features": embedding.features.cpu(),
+                "input_size": list(embedding.input_size),
+                "original_size": list(embedding.original_size),
+            }
+            with atomic_write(self._path(key)) as tmp_path:
+                torch.save(entry, tmp_path)
+
+    def clear(self) -> None:
+        """Removes all embeddings from memory. The on-disk tier is kept."""
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _insert(self, key: str, embedding: ImageEmbedding) -> None:
+        size = embedding.features.numel() * embedding.features.element_size()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = embedding
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes and len(self._entries) > 0:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= evicted.features.numel() * evicted.features.element_size()
+
+    def _path(self, key: str) -> str:
+        assert self.cache_dir is not None
+        return os.path.join(self.cache_dir, key + ".pt")
+
+
+class SamPromptPredictor:
+    def __init__(
         self,
-        transformed_image: torch.Tensor,
-        original_image_size: Tuple[int, ...],
+        sam_model: SamPromptDecoder,
+        precision: str = "fp32",
     ) -> None:
         """
-        Calculates the image embeddings for the provided image, allowing
-        masks to be predicted with the 'predict' method. Expects the input
-        image to be already transformed to the format expected by the model.
+        Uses the prompt encoder and mask decoder of SAM to predict masks from
+        precomputed image embeddings, without running an image encoder.
+        Embeddings can come from SamPredictor.encode_batch and be passed to
+        'predict' or set with 'set_embedding'. Works with a full Sam model or
+        with the much smaller model returned by build_sam_decoder.
+
+        'predict' and 'predict_torch' called with an embedding neither read
+        nor modify the predictor's current image, so one predictor can serve
+        prompts for many images from many threads at once.
 
         Arguments:
-          transformed_image (torch.Tensor): The input image, with shape
-            1x3xHxW, which has been transformed with ResizeLongestSide.
-          original_image_size (tuple(int, int)): The size of the image
-            before transformation, in (H, W) format.
+          sam_model (SamPromptDecoder): The model to use for mask prediction.
+          precision (str): The precision to run the mask decoder at, 'fp32'
+            or 'bf16'. See SamPromptDecoder.autocast. Returned masks, logits
+            and scores are always fp32.
         """
-        assert (
-            len(transformed_image.shape) == 4
-            and transformed_image.shape[1] == 3
-            and max(*transformed_image.shape[2:]) == self.model.image_encoder.img_size
-        ), f"set_torch_image input must be BCHW with long side {self.model.image_encoder.img_size}."
+        super().__init__()
+        assert precision in ["fp32", "bf16"], f"Unknown precision {precision}."
+        self.model = sam_model
+        self.precision = precision
+        self.transform = ResizeLongestSide(sam_model.img_size)
+        self._embedding: Optional[ImageEmbedding] = None
         self.reset_image()
 
-        self.original_size = original_image_size
-        self.input_size = tuple(transformed_image.shape[-2:])
-        input_image = self.model.preprocess(transformed_image)
-        self.features = self.model.image_encoder(input_image)
-        self.is_image_set = True
+    def set_embedding(self, embedding: ImageEmbedding) -> None:
+        """
+        Sets a precomputed image embedding as the current image, allowing
+        masks to be predicted with the 'predict' method without running the
+        image encoder.
+
+        Arguments:
+          embedding (ImageEmbedding): The embedding, as returned by
+            SamPredictor.encode_batch.
+        """
+        # The current image is a single attribute, so it is replaced atomically
+        self._embedding = embedding.to(self.device)
 
     def predict(
         self,
@@ -97,9 +185,13 @@ class SamPredictor:
         mask_input: Optional[np.ndarray] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
-    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        embedding: Optional[ImageEmbedding] = None,
+        output_format: str = "masks",
+        best_mask_only: bool = False,
+    ) -> Tuple[Any, np.ndarray, np.ndarray]:
         """
-        Predict masks for the given input prompts, using the currently set image.
+        Predict masks for the given input prompts, using the currently set image
+        or the given image embedding.
 
         Arguments:
           point_coords (np.ndarray or None): A Nx2 array of point prompts to the
@@ -120,18 +212,45 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          embedding (ImageEmbedding or None): If given, predict masks for this
+            embedding instead of the currently set image.
+          output_format (str): The form the masks are returned in, to limit
+            what is computed and copied from the device for large images.
+            'masks' returns full masks. 'packed' returns binary masks with
+            the bits of each row packed as by np.packbits(axis=-1), which
+            np.unpackbits(masks, axis=-1, count=W) reverses. 'rle' returns
+            a list of uncompressed COCO RLEs. 'cropped' returns a dict with
+            the masks inside the box outside of which they are empty as
+            'crop', in CxhxW format, and that box in XYXY format as 'box'.
+            'low_res' does not upscale the masks and returns None, leaving
+            only the low resolution logits. 'packed' and 'rle' require
+            return_logits=False.
+          best_mask_only (bool): If true, only the mask with the highest
+            predicted quality is upscaled and returned, so C is 1. The mask
+            is selected on the device.
 
         Returns:
           (np.ndarray): The output masks in CxHxW format, where C is the
-            number of masks, and (H, W) is the original image size.
+            number of masks, and (H, W) is the original image size. Other
+            output formats are as described for output_format.
           (np.ndarray): An array of length C containing the model's
             predictions for the quality of each mask.
           (np.ndarray): An array of shape CxHxW, where C is the number
             of masks and H=W=256. These low resolution logits can be passed to
             a subsequent iteration as mask input.
         """
-        if not self.is_image_set:
-            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
+        assert output_format in [
+            "masks",
+            "packed",
+            "rle",
+            "cropped",
+            "low_res",
+        ], f"Unknown output_format {output_format}."
+        assert not return_logits or output_format not in [
+            "packed",
+            "rle",
+        ], f"output_format '{output_format}' requires return_logits=False."
+        embedding = self._get_embedding(embedding)
 
         # Transform input prompts
         coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
@@ -139,31 +258,69 @@ class SamPredictor:
             assert (
                 point_labels is not None
             ), "point_labels must be supplied if point_coords is supplied."
-            point_coords = self.transform.apply_coords(point_coords, self.original_size)
+            point_coords = self.transform.apply_coords(point_coords, embedding.original_size)
             coords_torch = torch.as_tensor(point_coords, dtype=torch.float, device=self.device)
             labels_torch = torch.as_tensor(point_labels, dtype=torch.int, device=self.device)
             coords_torch, labels_torch = coords_torch[None, :, :], labels_torch[None, :]
         if box is not None:
-            box = self.transform.apply_boxes(box, self.original_size)
+            box = self.transform.apply_boxes(box, embedding.original_size)
             box_torch = torch.as_tensor(box, dtype=torch.float, device=self.device)
             box_torch = box_torch[None, :]
         if mask_input is not None:
             mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=self.device)
             mask_input_torch = mask_input_torch[None, :, :, :]
 
-        masks, iou_predictions, low_res_masks = self.predict_torch(
-            coords_torch,
-            labels_torch,
-            box_torch,
-            mask_input_torch,
-            multimask_output,
-            return_logits=return_logits,
-        )
+        masks_out: Any
+        if output_format == "low_res":
+            with torch.no_grad():
+                _, low_res_masks, iou_predictions = self._predict_low_res(
+                    coords_torch,
+                    labels_torch,
+                    box_torch,
+                    mask_input_torch,
+                    multimask_output,
+                    embedding,
+                    best_mask_only,
+                )
+            masks_out = None
+        elif output_format == "cropped":
+            crops, iou_predictions, low_res_masks, roi_boxes = self.predict_torch_roi(
+                coords_torch,
+                labels_torch,
+                box_torch,
+                mask_input_torch,
+                multimask_output,
+                return_logits=return_logits,
+                embedding=embedding,
+                roi="mask",
+                best_mask_only=best_mask_only,
+            )
+            masks_out = {
+                "crop": crops[0].detach().cpu().numpy(),
+                "box": roi_boxes[0].detach().cpu().numpy(),
+            }
+        else:
+            masks, iou_predictions, low_res_masks = self.predict_torch(
+                coords_torch,
+                labels_torch,
+                box_torch,
+                mask_input_torch,
+                multimask_output,
+                return_logits=return_logits,
+                embedding=embedding,
+                best_mask_only=best_mask_only,
+            )
+            # Compact the masks on the device, so only the result is copied
+            if output_format == "packed":
+                masks_out = _pack_bits(masks[0]).cpu().numpy()
+            elif output_format == "rle":
+                masks_out = mask_to_rle_pytorch(masks[0])
+            else:
+                masks_out = masks[0].detach().cpu().numpy()
 
-        masks_np = masks[0].detach().cpu().numpy()
         iou_predictions_np = iou_predictions[0].detach().cpu().numpy()
         low_res_masks_np = low_res_masks[0].detach().cpu().numpy()
-        return masks_np, iou_predictions_np, low_res_masks_np
+        return masks_out, iou_predictions_np, low_res_masks_np
 
     @torch.no_grad()
     def predict_torch(
@@ -174,11 +331,14 @@ class SamPredictor:
         mask_input: Optional[torch.Tensor] = None,
         multimask_output: bool = True,
         return_logits: bool = False,
+        embedding: Optional[ImageEmbedding] = None,
+        best_mask_only: bool = False,
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """
-        Predict masks for the given input prompts, using the currently set image.
-        Input prompts are batched torch tensors and are expected to already be
-        transformed to the input frame using ResizeLongestSide.
+        Predict masks for the given input prompts, using the currently set image
+        or the given image embedding. Input prompts are batched torch tensors and
+        are expected to already be transformed to the input frame using
+        ResizeLongestSide.
 
         Arguments:
           point_coords (torch.Tensor or None): A BxNx2 array of point prompts to the
@@ -200,6 +360,11 @@ class SamPredictor:
             input prompts, multimask_output=False can give better results.
           return_logits (bool): If true, returns un-thresholded masks logits
             instead of a binary mask.
+          embedding (ImageEmbedding or None): If given, predict masks for this
+            embedding instead of the currently set image.
+          best_mask_only (bool): If true, only the mask with the highest
+            predicted quality of each prompt is upscaled and returned, so C
+            is 1 in all outputs.
 
         Returns:
           (torch.Tensor): The output masks in BxCxHxW format, where C is the
@@ -210,50 +375,266 @@ class SamPredictor:
             of masks and H=W=256. These low res logits can be passed to
             a subsequent iteration as mask input.
         """
-        if not self.is_image_set:
-            raise RuntimeError("An image must be set with .set_image(...) before mask prediction.")
-
-        if point_coords is not None:
-            points = (point_coords, point_labels)
-        else:
-            points = None
-
-        # Embed prompts
-        sparse_embeddings, dense_embeddings = self.model.prompt_encoder(
-            points=points,
-            boxes=boxes,
-            masks=mask_input,
-        )
-
-        # Predict masks
-        low_res_masks, iou_predictions = self.model.mask_decoder(
-            image_embeddings=self.features,
-            image_pe=self.model.prompt_encoder.get_dense_pe(),
-            sparse_prompt_embeddings=sparse_embeddings,
-            dense_prompt_embeddings=dense_embeddings,
-            multimask_output=multimask_output,
+        embedding, low_res_masks, iou_predictions = self._predict_low_res(
+            point_coords,
+            point_labels,
+            boxes,
+            mask_input,
+            multimask_output,
+            embedding,
+            best_mask_only,
         )
 
         # Upscale the masks to the original image resolution
-        masks = self.model.postprocess_masks(low_res_masks, self.input_size, self.original_size)
+        masks = self.model.postprocess_masks(
+            low_res_masks, embedding.input_size, embedding.original_size
+        )
 
         if not return_logits:
             masks = masks > self.model.mask_threshold
 
         return masks, iou_predictions, low_res_masks
 
+    @torch.no_grad()
+    def predict_torch_roi(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+        embedding: Optional[ImageEmbedding] = None,
+        roi: str = "mask",
+        best_mask_only: bool = False,
+    ) -> Tuple[List[torch.Tensor], torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Like predict_torch, but masks are only upscaled inside a region of
+        each prompt, using Sam.postprocess_masks_roi, and returned as crops.
+        Arguments are as for predict_torch.
+
+        Arguments:
+          roi (str): The region of each prompt. 'mask' uses the region outside
+            of which the masks are empty, found from the low res logits. 'box'
+            uses the box prompt, outside of which masks are then cut off.
+
+        Returns:
+          (list(torch.Tensor)): The CxhxW masks inside the region of each
+            prompt.
+          (torch.Tensor): An array of shape BxC containing the model's
+            predictions for the quality of each mask.
+          (torch.Tensor): An array of shape BxCxHxW, where C is the number
+            of masks and H=W=256. These low res logits can be passed to
+            a subsequent iteration as mask input.
+          (torch.Tensor): An array of shape Bx4 with the region of each
+            prompt in XYXY format, in pixels of the original image. Its first
+            two columns are the offset of each crop in the full mask.
+        """
+        assert roi in ["mask", "box"], f"Unknown roi {roi}."
+        assert roi != "box" or boxes is not None, "roi='box' requires box prompts."
+        embedding, low_res_masks, iou_predictions = self._predict_low_res(
+            point_coords,
+            point_labels,
+            boxes,
+            mask_input,
+            multimask_output,
+            embedding,
+            best_mask_only,
+        )
+
+        roi_boxes = None
+        if roi == "box" and boxes is not None:
+            # Map the box prompts from the input frame back to the original image
+            scale = torch.tensor(embedding.original_size, device=boxes.device) / torch.tensor(
+                embedding.input_size, device=boxes.device
+            )
+            roi_boxes = boxes.float() * scale.flip(0).repeat(2)
+        crops, roi_boxes = self.model.postprocess_masks_roi(
+            low_res_masks, embedding.input_size, embedding.original_size, roi_boxes
+        )
+        if not return_logits:
+            crops = [crop > self.model.mask_threshold for crop in crops]
+        return crops, iou_predictions, low_res_masks, roi_boxes
+
+    def _predict_low_res(
+        self,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor],
+        mask_input: Optional[torch.Tensor],
+        multimask_output: bool,
+        embedding: Optional[ImageEmbedding],
+        best_mask_only: bool,
+    ) -> Tuple[ImageEmbedding, torch.Tensor, torch.Tensor]:
+        """Decodes the prompts of one image, returning its embedding, low res logits and scores."""
+        embedding = self._get_embedding(embedding)
+        low_res_masks, iou_predictions = self._decode(
+            embedding.features,
+            None,
+            point_coords,
+            point_labels,
+            boxes,
+            mask_input,
+            multimask_output,
+        )
+        if best_mask_only:
+            low_res_masks, iou_predictions = self._select_best_mask(low_res_masks, iou_predictions)
+        return embedding, low_res_masks, iou_predictions
+
+    @torch.no_grad()
+    def predict_torch_batch(
+        self,
+        embeddings: List[ImageEmbedding],
+        image_indices: torch.Tensor,
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor] = None,
+        mask_input: Optional[torch.Tensor] = None,
+        multimask_output: bool = True,
+        return_logits: bool = False,
+    ) -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """
+        Predict masks for prompts on several images with a single batched
+        pass of the mask decoder. Prompts are given as in 'predict_torch',
+        each already transformed to the input frame of its own image, and
+        all prompts must have the same number of points.
+
+        Arguments:
+          embeddings (list(ImageEmbedding)): The embeddings of the images.
+          image_indices (torch.Tensor): The index into embeddings of the
+            image of each prompt, with shape B.
+          point_coords (torch.Tensor or None): A BxNx2 array of point prompts.
+          point_labels (torch.Tensor or None): A BxN array of point labels.
+          boxes (torch.Tensor or None): A Bx4 array of box prompts.
+          mask_input (torch.Tensor or None): A Bx1xHxW array of low
+            resolution mask inputs.
+          multimask_output (bool): If true, the model will return three masks.
+          return_logits (bool): If true, returns un-thresholded masks logits
+            instead of a binary mask.
+
+        Returns:
+          (list(tuple(torch.Tensor, torch.Tensor, torch.Tensor))): For each
+            embedding, the masks, quality predictions and low resolution
+            logits of its prompts, in their order in the batch, as returned
+            by 'predict_torch'.
+        """
+        features = torch.cat([embedding.to(self.device).features for embedding in embeddings])
+        low_res_masks, iou_predictions = self._decode(
+            features,
+            image_indices,
+            point_coords,
+            point_labels,
+            boxes,
+            mask_input,
+            multimask_output,
+        )
+
+        outputs = []
+        for i, embedding in enumerate(embeddings):
+            in_image = image_indices == i
+            image_low_res_masks = low_res_masks[in_image]
+            masks = self.model.postprocess_masks(
+                image_low_res_masks, embedding.input_size, embedding.original_size
+            )
+            if not return_logits:
+                masks = masks > self.model.mask_threshold
+            outputs.append((masks, iou_predictions[in_image], image_low_res_masks))
+        return outputs
+
+    def _decode(
+        self,
+        features: torch.Tensor,
+        image_indices: Optional[torch.Tensor],
+        point_coords: Optional[torch.Tensor],
+        point_labels: Optional[torch.Tensor],
+        boxes: Optional[torch.Tensor],
+        mask_input: Optional[torch.Tensor],
+        multimask_output: bool,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Runs the prompt encoder and mask decoder, returning fp32 low res logits and scores."""
+        if point_coords is not None:
+            points = (point_coords, point_labels)
+        else:
+            points = None
+
+        with self.model.autocast(self.precision):
+            # Embed prompts
+            sparse_embeddings, dense_embeddings = self.model.prompt_encoder(
+                points=points,
+                boxes=boxes,
+                masks=mask_input,
+            )
+
+            # Predict masks
+            low_res_masks, iou_predictions = self.model.mask_decoder(
+                image_embeddings=features,
+                image_pe=self.model.prompt_encoder.get_dense_pe(),
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=multimask_output,
+                image_indices=image_indices,
+            )
+        return low_res_masks.float(), iou_predictions.float()
+
+    def _select_best_mask(
+        self, low_res_masks: torch.Tensor, iou_predictions: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Keeps the mask with the highest predicted quality of each prompt."""
+        best = iou_predictions.argmax(dim=1, keepdim=True)
+        low_res_masks = low_res_masks.gather(
+            1, best[:, :, None, None].expand(-1, -1, *low_res_masks.shape[2:])
+        )
+        return low_res_masks, iou_predictions.gather(1, best)
+
+    def _get_embedding(self, embedding: Optional[ImageEmbedding]) -> ImageEmbedding:
+        """Returns the given embedding, or the embedding of the currently set image."""
+        if embedding is None:
+            # Read once, so a concurrent set_image or reset_image can't mix two images
+            embedding = self._embedding
+        if embedding is None:
+            raise RuntimeError(
+                "An image must be set with .set_image(...) or .set_embedding(...) "
+                "before mask prediction."
+            )
+        # Embeddings may be stored elsewhere, e.g. on the CPU by an EmbeddingStore
+        return embedding.to(self.device)
+
     def get_image_embedding(self) -> torch.Tensor:
         """
         Returns the image embeddings for the currently set image, with
         shape 1xCxHxW, where C is the embedding dimension and (H,W) are
         the embedding spatial dimension of SAM (typically C=256, H=W=64).
         """
-        if not self.is_image_set:
+        embedding = self._embedding
+        if embedding is None:
             raise RuntimeError(
                 "An image must be set with .set_image(...) to generate an embedding."
             )
-        assert self.features is not None, "Features must exist if an image has been set."
-        return self.features
+        return embedding.features
+
+    @property
+    def embedding(self) -> Optional[ImageEmbedding]:
+        """The embedding of the currently set image, or None."""
+        return self._embedding
+
+    @property
+    def is_image_set(self) -> bool:
+        return self._embedding is not None
+
+    @property
+    def features(self) -> Optional[torch.Tensor]:
+        embedding = self._embedding
+        return embedding.features if embedding is not None else None
+
+    @property
+    def original_size(self) -> Optional[Tuple[int, ...]]:
+        embedding = self._embedding
+        return embedding.original_size if embedding is not None else None
+
+    @property
+    def input_size(self) -> Optional[Tuple[int, ...]]:
+        embedding = self._embedding
+        return embedding.input_size if embedding is not None else None
 
     @property
     def device(self) -> torch.device:
@@ -261,9 +642,293 @@ class SamPredictor:
 
     def reset_image(self) -> None:
         """Resets the currently set image."""
-        self.is_image_set = False
-        self.features = None
+        self._embedding = None
         self.orig_h = None
         self.orig_w = None
         self.input_h = None
         self.input_w = None
+
+
+class SamPredictor(SamPromptPredictor):
+    def __init__(
+        self,
+        sam_model: Sam,
+        precision: str = "fp32",
+        embedding_cache: Optional[EmbeddingCache] = None,
+        model_id: Optional[str] = None,
+        fused_preprocessing: bool = False,
+    ) -> None:
+        """
+        Uses SAM to calculate the image embedding for an image, and then
+        allow repeated, efficient mask prediction given prompts.
+
+        Arguments:
+          sam_model (Sam): The model to use for mask prediction.
+          precision (str): The precision to run the image encoder and mask
+            decoder at, 'fp32' or 'bf16'. See Sam.autocast. Under 'bf16',
+            image embeddings are kept in bfloat16, while returned masks,
+            logits and scores are always fp32. A quantized image encoder
+            always runs in fp32, see Sam.encoder_autocast.
+          embedding_cache (EmbeddingCache or None): If set, 'set_image' and
+            'encode_batch' look up embeddings of previously seen images in
+            this cache instead of running the image encoder.
+          model_id (str or None): Identifies the model in embedding cache
+            keys. If None, a fingerprint of the model's structure, including
+            the image encoder options shown in repr(model), and weights is
+            used.
+          fused_preprocessing (bool): If True, images are resized with
+            torch's antialiased uint8 kernel and normalized and padded
+            straight into a reused input buffer, which is several times
+            faster for large images. The resize is not bit-exact with the
+            default PIL resize: some pixels differ by 1 or 2, so masks can
+            differ slightly. See scripts/verify_preprocessing.py.
+        """
+        super().__init__(sam_model, precision=precision)
+        # Narrows the type set by SamPromptPredictor, which only needs the prompt modules
+        self.model: Sam = sam_model
+        self.embedding_cache = embedding_cache
+        self.model_id = model_id
+        self.fused_preprocessing = fused_preprocessing
+        # Reused encoder input, guarded since it is written and read per call
+        self._input_buffer: Optional[torch.Tensor] = None
+        self._input_lock = threading.Lock()
+
+    def set_image(
+        self,
+        image: np.ndarray,
+        image_format: str = "RGB",
+    ) -> None:
+        """
+        Calculates the image embeddings for the provided image, allowing
+        masks to be predicted with the 'predict' method.
+
+        Arguments:
+          image (np.ndarray): The image for calculating masks. Expects an
+            image in HWC uint8 format, with pixel values in [0, 255].
+          image_format (str): The color format of the image, in ['RGB', 'BGR'].
+        """
+        self.reset_image()
+        self.set_embedding(self.encode_batch([image], image_format)[0])
+
+    def _transform_image(self, image: np.ndarray, image_format: str) -> torch.Tensor:
+        """Transforms a HWC uint8 image to a 1x3xHxW tensor in the model's input frame."""
+        if image_format != self.model.image_format:
+            image = image[..., ::-1]
+
+        # Transform the image to the form expected by the model
+        input_image = self.transform.apply_image(image)
+        input_image_torch = torch.as_tensor(input_image, device=self.device)
+        return input_image_torch.permute(2, 0, 1).contiguous()[None, :, :, :]
+
+    @torch.no_grad()
+    def _encode_images(self, images: List[np.ndarray], image_format: str) -> List[ImageEmbedding]:
+        """
+        Embeds HWC uint8 images. With fused_preprocessing, each image is
+        resized, normalized and padded straight into a reused input buffer,
+        with BGR images converted while writing rather than copied.
+        """
+        assert image_format in [
+            "RGB",
+            "BGR",
+        ], f"image_format must be in ['RGB', 'BGR'], is {image_format}."
+        if len(images) == 0:
+            return []
+        if not self.fused_preprocessing:
+            transformed_images = [self._transform_image(image, image_format) for image in images]
+            return self.encode_torch_batch(
+                transformed_images, [image.shape[:2] for image in images]
+            )
+        flip_channels = image_format != self.model.image_format
+        img_size = self.model.img_size
+        with self._input_lock:
+            buffer = self._input_buffer
+            if buffer is None or buffer.shape[0] < len(images) or buffer.device != self.device:
+                buffer = torch.empty(len(images), 3, img_size, img_size, device=self.device)
+                self._input_buffer = buffer
+            input_sizes = []
+            for i, image in enumerate(images):
+                input_image = self.transform.apply_image_uint8_torch(image)
+                self.model.preprocess_into(input_image, buffer[i], flip_channels=flip_channels)
+                input_sizes.append(tuple(input_image.shape[-2:]))
+            return self._encode_inputs(
+                buffer[: len(images)], input_sizes, [image.shape[:2] for image in images]
+            )
+
+    @torch.no_grad()
+    def set_torch_image(
+        self,
+        transformed_image: torch.Tensor,
+        original_image_size: Tuple[int, ...],
+    ) -> None:
+        """
+        Calculates the image embeddings for the provided image, allowing
+        masks to be predicted with the 'predict' method. Expects the input
+        image to be already transformed to the format expected by the model.
+
+        Arguments:
+          transformed_image (torch.Tensor): The input image, with shape
+            1x3xHxW, which has been transformed with ResizeLongestSide.
+          original_image_size (tuple(int, int)): The size of the image
+            before transformation, in (H, W) format.
+        """
+        self.reset_image()
+        embedding = self.encode_torch_batch([transformed_image], [original_image_size])[0]
+        self.set_embedding(embedding)
+
+    def encode(
+        self,
+        image: np.ndarray,
+        image_format: str = "RGB",
+    ) -> ImageEmbedding:
+        """
+        Calculates the image embedding for the provided image without
+        changing the currently set image. The returned embedding is a handle
+        that can be passed to 'predict' and 'predict_torch' from any thread.
+
+        Arguments:
+          image (np.ndarray): The image for calculating masks. Expects an
+            image in HWC uint8 format, with pixel values in [0, 255].
+          image_format (str): The color format of the image, in ['RGB', 'BGR'].
+
+        Returns:
+          (ImageEmbedding): The embedding of the image.
+        """
+        return self.encode_batch([image], image_format)[0]
+
+    def encode_batch(
+        self,
+        images: List[np.ndarray],
+        image_format: str = "RGB",
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings for a list of images with a single
+        batched pass of the image encoder. The currently set image is not
+        changed; the returned embeddings can be passed to 'predict' or
+        'predict_torch', or made current with 'set_embedding'.
+
+        Arguments:
+          images (list(np.ndarray)): The images to embed, each in HWC uint8
+            format with pixel values in [0, 255]. Images may have different sizes.
+          image_format (str): The color format of the images, in ['RGB', 'BGR'].
+
+        Returns:
+          (list(ImageEmbedding)): One embedding per input image, in order.
+        """
+        if self.embedding_cache is None:
+            return self._encode_images(images, image_format)
+
+        keys = [self._cache_key(image, image_format) for image in images]
+        embeddings: List[Optional[ImageEmbedding]] = [self.embedding_cache.get(k) for k in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        new_embeddings = self._encode_images([images[i] for i in missing], image_format)
+        for i, embedding in zip(missing, new_embeddings):
+            self.embedding_cache.put(keys[i], embedding)
+            embeddings[i] = embedding
+        return [
+            ImageEmbedding(e.features.to(self.device), e.input_size, e.original_size)
+            for e in embeddings
+            if e is not None
+        ]
+
+    def _cache_key(self, image: np.ndarray, image_format: str) -> str:
+        """The embedding cache key of an image: a hash of its bytes and the model identity."""
+        if self.model_id is None:
+            self.model_id = self._fingerprint_model()
+        hasher = hashlib.sha256()
+        hasher.update(f"{self.model_id}|{self.precision}|{image_format}|".encode())
+        if self.fused_preprocessing:
+            # The fused resize differs slightly from PIL, so its embeddings are keyed apart
+            hasher.update(b"fused|")
+        hasher.update(f"{image.shape}|{image.dtype}|".encode())
+        hasher.update(np.ascontiguousarray(image).data)
+        return hasher.hexdigest()
+
+    def _fingerprint_model(self) -> str:
+        """
+        Hashes the model's structure and a sample of values from every tensor
+        in its state dict, which is cheap and distinguishes checkpoints.
+        """
+        hasher = hashlib.sha256(repr(self.model).encode())
+        for name, tensor in self.model.state_dict().items():
+            if not isinstance(tensor, torch.Tensor):
+                continue
+            if tensor.is_quantized:
+                tensor = tensor.int_repr()
+            flat = tensor.detach().flatten()
+            if flat.numel() > 0:
+                flat = flat[torch.linspace(0, flat.numel() - 1, 16, device=flat.device).long()]
+            hasher.update(f"{name}|{tuple(tensor.shape)}|{tensor.dtype}|".encode())
+            hasher.update(flat.float().cpu().numpy().tobytes())
+        return hasher.hexdigest()[:16]
+
+    @torch.no_grad()
+    def encode_torch_batch(
+        self,
+        transformed_images: List[torch.Tensor],
+        original_image_sizes: List[Tuple[int, ...]],
+    ) -> List[ImageEmbedding]:
+        """
+        Calculates the image embeddings for a list of images with a single
+        batched pass of the image encoder. Expects the input images to be
+        already transformed to the format expected by the model.
+
+        Arguments:
+          transformed_images (list(torch.Tensor)): The input images, each with
+            shape 1x3xHxW, which have been transformed with ResizeLongestSide.
+          original_image_sizes (list(tuple(int, int))): The sizes of the images
+            before transformation, in (H, W) format.
+
+        Returns:
+          (list(ImageEmbedding)): One embedding per input image, in order.
+        """
+        assert len(transformed_images) == len(
+            original_image_sizes
+        ), "Each transformed image must have an original image size."
+        img_size = self.model.img_size
+        for transformed_image in transformed_images:
+            assert (
+                len(transformed_image.shape) == 4
+                and transformed_image.shape[1] == 3
+                and max(*transformed_image.shape[2:]) == img_size
+            ), f"set_torch_image input must be BCHW with long side {img_size}."
+        if len(transformed_images) == 0:
+            return []
+
+        input_images = torch.cat([self.model.preprocess(x) for x in transformed_images], dim=0)
+        return self._encode_inputs(
+            input_images,
+            [tuple(x.shape[-2:]) for x in transformed_images],
+            original_image_sizes,
+        )
+
+    def _encode_inputs(
+        self,
+        input_images: torch.Tensor,
+        input_sizes: List[Tuple[int, ...]],
+        original_image_sizes: List[Tuple[int, ...]],
+    ) -> List[ImageEmbedding]:
+        """Runs the image encoder on preprocessed, padded Bx3xSxS input images."""
+        with self.model.encoder_autocast(self.precision):
+            features = self.model.image_encoder(input_images, input_sizes=input_sizes)
+        return [
+            ImageEmbedding(
+                features=features[i : i + 1].clone(),
+                input_size=input_size,
+                original_size=original_image_size,
+            )
+            for i, (input_size, original_image_size) in enumerate(
+                zip(input_sizes, original_image_sizes)
+            )
+        ]
+
+
+def _pack_bits(masks: torch.Tensor) -> torch.Tensor:
+    """
+    Packs boolean masks with shape ...xHxW into uint8 with shape
+    ...xHx(ceil(W/8)), in the bit order of np.packbits(axis=-1).
+    """
+    pad = -masks.shape[-1] % 8
+    bits = torch.nn.functional.pad(masks.to(torch.uint8), (0, pad))
+    bits = bits.view(*bits.shape[:-1], -1, 8)
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=masks.device)
+    return (bits << shifts).sum(dim=-1, dtype=torch.uint8)
@@ -0,0 +1,403 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import torch
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .predictor import ImageEmbedding, SamPredictor
+
+
+class _Request:
+    """A queued request: its arguments, the future of its result and when it was queued."""
+
+    def __init__(self, args: Dict[str, Any], future: asyncio.Future) -> None:
+        self.args = args
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+
+class _StageStats:
+    """Request, batch and latency counters of one stage of the service."""
+
+    def __init__(self, window: int) -> None:
+        self.num_requests = 0
+        self.num_batches = 0
+        self.in_flight = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+
+    def summary(self, queue_depth: int) -> Dict[str, Any]:
+        latencies_ms = np.array(self.latencies) * 1000
+        percentiles = {}
+        for p in [50, 90, 99]:
+            percentiles[f"p{p}"] = (
+                float(np.percentile(latencies_ms, p)) if len(latencies_ms) > 0 else None
+            )
+        return {
+            "queue_depth": queue_depth,
+            "in_flight": self.in_flight,
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "mean_batch_size": self.num_requests / max(self.num_batches, 1),
+            "latency_ms": percentiles,
+        }
+
+
+class SamService:
+    def __init__(
+        self,
+        predictor: SamPredictor,
+        max_encoder_batch: int = 4,
+        max_decoder_batch: int = 64,
+        max_wait_ms: float = 5.0,
+        stats_window: int = 1000,
+    ) -> None:
+        """
+        An asyncio front-end to a SamPredictor that serves many concurrent
+        clients. 'encode' and 'predict' requests are queued, and a scheduler
+        per stage groups them into batches: up to max_encoder_batch images
+        per call of the image encoder, and up to max_decoder_batch prompts,
+        for the same or different images, per call of the mask decoder. A
+        batch is run once it is full or its first request has waited
+        max_wait_ms. Model calls run on one worker thread per stage, so the
+        event loop is never blocked and the encoder and decoder can run at
+        the same time.
+
+        Use as 'async with SamService(predictor) as service:', or call
+        'start' and 'stop'.
+
+        Arguments:
+          predictor (SamPredictor): The predictor to run. Its currently set
+            image is not used or changed.
+          max_encoder_batch (int): The most images embedded in one batch.
+          max_decoder_batch (int): The most prompts decoded in one batch.
+          max_wait_ms (float): How long a request may wait for more requests
+            to join its batch, in milliseconds.
+          stats_window (int): How many recent requests per stage latency
+            percentiles are computed over.
+        """
+        self.predictor = predictor
+        self.max_encoder_batch = max_encoder_batch
+        self.max_decoder_batch = max_decoder_batch
+        self.max_wait_ms = max_wait_ms
+
+        self._encoder_queue: Optional[asyncio.Queue] = None
+        self._decoder_queue: Optional[asyncio.Queue] = None
+        self._encoder_stats = _StageStats(stats_window)
+        self._decoder_stats = _StageStats(stats_window)
+        self._executors: List[ThreadPoolExecutor] = []
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        """Starts the schedulers. Must be called from the event loop that serves requests."""
+        assert not self._workers, "The service is already running."
+        self._encoder_queue = asyncio.Queue()
+        self._decoder_queue = asyncio.Queue()
+        self._executors = [ThreadPoolExecutor(max_workers=1) for _ in range(2)]
+        self._workers = [
+            asyncio.create_task(
+                self._schedule(
+                    self._encoder_queue,
+                    self.max_encoder_batch,
+                    self._run_encoder_batch,
+                    self._executors[0],
+                    self._encoder_stats,
+                )
+            ),
+            asyncio.create_task(
+                self._schedule(
+                    self._decoder_queue,
+                    self.max_decoder_batch,
+                    self._run_decoder_batch,
+                    self._executors[1],
+                    self._decoder_stats,
+                )
+            ),
+        ]
+
+    async def stop(self) -> None:
+        """Stops the schedulers. Requests that have not finished are cancelled."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for queue in [self._encoder_queue, self._decoder_queue]:
+            while queue is not None and not queue.empty():
+                queue.get_nowait().future.cancel()
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        self._workers = []
+        self._executors = []
+
+    async def __aenter__(self) -> "SamService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.stop()
+
+    async def encode(self, image: np.ndarray, image_format: str = "RGB") -> ImageEmbedding:
+        """
+        Calculates the image embedding of an image, batched with the images
+        of other pending requests. See SamPredictor.encode.
+
+        Arguments:
+          image (np.ndarray): The image, in HWC uint8 format.
+          image_format (str): The color format of the image, in ['RGB', 'BGR'].
+
+        Returns:
+          (ImageEmbedding): The embedding, to pass to 'predict'.
+        """
+        assert self._encoder_queue is not None, "The service must be started first."
+        return await self._submit(
+            self._encoder_queue, {"image": image, "image_format": image_format}
+        )
+
+    async def predict(
+        self,
+        embedding: ImageEmbedding,
+        point_coords: Optional[np.ndarray] = None,
+        point_labels: Optional[np.ndarray] = None,
+        box: Optional[np.ndarray] = None,
+        mask_input: Optional[np.ndarray] = None,
+        multimask_output: bool = True,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Predicts masks for the given prompts, decoded together with the
+        prompts of other pending requests that have the same number of
+        points, the same kinds of prompts and the same multimask_output.
+        Arguments and outputs are as for SamPredictor.predict.
+        """
+        assert self._decoder_queue is not None, "The service must be started first."
+        # Check inputs here, so that a malformed request cannot fail the batch it joins
+        prompt_encoder = self.predictor.model.prompt_encoder
+        assert tuple(embedding.features.shape) == (
+            1,
+            prompt_encoder.embed_dim,
+            *prompt_encoder.image_embedding_size,
+        ), "embedding does not match the image embedding size of the model."
+        if point_coords is not None:
+            assert (
+                point_labels is not None
+            ), "point_labels must be supplied if point_coords is supplied."
+            assert (
+                point_coords.ndim == 2 and point_coords.shape[1] == 2
+            ), "point_coords must be Nx2."
+            assert point_labels.shape == (
+                len(point_coords),
+            ), "point_labels must have one label per point."
+        if box is not None:
+            assert box.size == 4, "box must have 4 coordinates."
+        if mask_input is not None:
+            assert mask_input.shape == (
+                1,
+                *prompt_encoder.mask_input_size,
+            ), "mask_input must be 1xHxW, with HxW the mask input size of the model."
+        args = {
+            "embedding": embedding,
+            "point_coords": point_coords,
+            "point_labels": point_labels,
+            "box": box,
+            "mask_input": mask_input,
+            "multimask_output": multimask_output,
+        }
+        return await self._submit(self._decoder_queue, args)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns, for the 'encoder' and 'decoder' stages, the number of queued
+        and running requests, request and batch counts, the mean batch size,
+        and the p50, p90 and p99 latency in milliseconds from queueing to
+        result over the most recent requests.
+        """
+        return {
+            "encoder": self._encoder_stats.summary(
+                self._encoder_queue.qsize() if self._encoder_queue is not None else 0
+            ),
+            "decoder": self._decoder_stats.summary(
+                self._decoder_queue.qsize() if self._decoder_queue is not None else 0
+            ),
+        }
+
+    async def _submit(self, queue: asyncio.Queue, args: Dict[str, Any]) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        await queue.put(_Request(args, future))
+        return await future
+
+    async def _schedule(self, queue, max_batch, run_batch, executor, stats) -> None:
+        """Repeatedly collects a batch of requests from queue and runs it on executor."""
+        loop = asyncio.get_running_loop()
+        batch: List[_Request] = []
+        try:
+            while True:
+                batch = [await queue.get()]
+                deadline = batch[0].queued_at + self.max_wait_ms / 1000
+                while len(batch) < max_batch:
+                    if not queue.empty():
+                        batch.append(queue.get_nowait())
+                        continue
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                batch = [request for request in batch if not request.future.cancelled()]
+                if not batch:
+                    continue
+                stats.in_flight = len(batch)
+                results: List[Any]
+                try:
+                    results = await loop.run_in_executor(
+                        executor, run_batch, [r.args for r in batch]
+                    )
+                except Exception as e:
+                    results = [e] * len(batch)
+                finally:
+                    stats.in_flight = 0
+                stats.num_batches += 1
+                finished_at = time.perf_counter()
+                for request, result in zip(batch, results):
+                    stats.num_requests += 1
+                    stats.latencies.append(finished_at - request.queued_at)
+                    if request.future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        request.future.set_exception(result)
+                    else:
+                        request.future.set_result(result)
+                batch = []
+        finally:
+            # On stop, also cancel the batch being collected or run, no longer in the queue
+            for request in batch:
+                request.future.cancel()
+
+    def _run_encoder_batch(self, batch: List[Dict[str, Any]]) -> List[Any]:
+        """Embeds the images of a batch, with one encoder call per image format."""
+        results: List[Any] = [None] * len(batch)
+        for image_format in set(args["image_format"] for args in batch):
+            indices = [i for i, args in enumerate(batch) if args["image_format"] == image_format]
+            embeddings: List[Any]
+            try:
+                embeddings = self.predictor.encode_batch(
+                    [batch[i]["image"] for i in indices], image_format
+                )
+            except Exception as e:
+                embeddings = [e] * len(indices)
+            for i, embedding in zip(indices, embeddings):
+                results[i] = embedding
+        return results
+
+    def _run_decoder_batch(self, batch: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Decodes the prompts of a batch. Prompts that can share a mask decoder
+        call, because they have the same number of points, the same kinds of
+        prompts and the same multimask_output, are decoded in one
+        'predict_torch_batch' call, whatever their images. If that call
+        fails, the prompts of the group are decoded one at a time.
+        """
+        groups: Dict[Tuple, List[int]] = {}
+        for i, args in enumerate(batch):
+            key = (
+                None if args["point_coords"] is None else len(args["point_coords"]),
+                args["box"] is not None,
+                args["mask_input"] is not None,
+                args["multimask_output"],
+            )
+            groups.setdefault(key, []).append(i)
+
+        results: List[Any] = [None] * len(batch)
+        for indices in groups.values():
+            outputs: List[Any]
+            try:
+                outputs = self._decode_group([batch[i] for i in indices])
+            except Exception as e:
+                outputs = [e] * len(indices)
+                if len(indices) > 1:
+                    # Decode the prompts one at a time, so that only failing requests fail
+                    outputs = [self._decode_single(batch[i]) for i in indices]
+            for i, output in zip(indices, outputs):
+                results[i] = output
+        return results
+
+    def _decode_single(self, args: Dict[str, Any]) -> Any:
+        try:
+            return self._decode_group([args])[0]
+        except Exception as e:
+            return e
+
+    @torch.no_grad()
+    def _decode_group(
+        self, group: List[Dict[str, Any]]
+    ) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        predictor = self.predictor
+        device = predictor.device
+
+        # Number the distinct images of the group
+        embeddings: List[ImageEmbedding] = []
+        embedding_index: Dict[int, int] = {}
+        image_indices = []
+        for args in group:
+            embedding = args["embedding"]
+            if id(embedding) not in embedding_index:
+                embedding_index[id(embedding)] = len(embeddings)
+                embeddings.append(embedding)
+            image_indices.append(embedding_index[id(embedding)])
+
+        # Transform each prompt to the input frame of its own image
+        coords_torch, labels_torch, box_torch, mask_input_torch = None, None, None, None
+        if group[0]["point_coords"] is not None:
+            coords = [
+                predictor.transform.apply_coords(
+                    args["point_coords"], args["embedding"].original_size
+                )
+                for args in group
+            ]
+            coords_torch = torch.as_tensor(np.stack(coords), dtype=torch.float, device=device)
+            labels = np.stack([args["point_labels"] for args in group])
+            labels_torch = torch.as_tensor(labels, dtype=torch.int, device=device)
+        if group[0]["box"] is not None:
+            boxes = [
+                predictor.transform.apply_boxes(args["box"], args["embedding"].original_size)
+                for args in group
+            ]
+            box_torch = torch.as_tensor(np.concatenate(boxes), dtype=torch.float, device=device)
+        if group[0]["mask_input"] is not None:
+            mask_input = np.stack([args["mask_input"] for args in group])
+            mask_input_torch = torch.as_tensor(mask_input, dtype=torch.float, device=device)
+
+        image_indices_torch = torch.as_tensor(image_indices, device=device)
+        outputs = predictor.predict_torch_batch(
+            embeddings,
+            image_indices_torch,
+            coords_torch,
+            labels_torch,
+            box_torch,
+            mask_input_torch,
+            multimask_output=group[0]["multimask_output"],
+        )
+
+        # Outputs of each image are in the order of its prompts in the group
+        results = []
+        next_prompt = [0] * len(embeddings)
+        for image_index in image_indices:
+            j = next_prompt[image_index]
+            next_prompt[image_index] += 1
+            masks, iou_predictions, low_res_masks = outputs[image_index]
+            results.append(
+                (
+                    masks[j].cpu().numpy(),
+                    iou_predictions[j].cpu().numpy(),
+                    low_res_masks[j].cpu().numpy(),
+                )
+            )
+        return results
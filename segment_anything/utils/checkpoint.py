@@ -0,0 +1,120 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import torch
+
+import json
+import mmap
+import struct
+from typing import Dict, Iterable, Optional
+
+# Reader and writer for the safetensors format: an 8 byte little-endian header
+# length, a json header mapping tensor names to dtype, shape and byte offsets,
+# then the raw tensor bytes. Implemented here so that loading needs no extra
+# dependency and can map tensors straight from the file.
+
+_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+_DTYPE_NAMES = {v: k for k, v in _DTYPES.items()}
+
+
+def save_safetensors(
+    state_dict: Dict[str, torch.Tensor],
+    path: str,
+    metadata: Optional[Dict[str, str]] = None,
+) -> None:
+    """
+    Saves a state dict of CPU tensors to a safetensors file.
+
+    Arguments:
+      state_dict (dict(str, torch.Tensor)): The tensors to save.
+      path (str): The output file.
+      metadata (dict(str, str) or None): Optional string metadata to store
+        in the header.
+    """
+    header: Dict[str, Dict] = {}
+    if metadata is not None:
+        header["__metadata__"] = metadata
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        assert tensor.dtype in _DTYPE_NAMES, f"Unsupported dtype {tensor.dtype} for {name}."
+        tensor = tensor.detach().cpu().contiguous()
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": _DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + num_bytes],
+        }
+        tensors.append(tensor)
+        offset += num_bytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # Pad the header with spaces so the tensor data starts 8 byte aligned
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for tensor in tensors:
+            if tensor.numel() > 0:
+                f.write(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+
+
+def load_safetensors(
+    path: str,
+    prefixes: Optional[Iterable[str]] = None,
+) -> Dict[str, torch.Tensor]:
+    """
+    Loads tensors from a safetensors file without copying them. The file is
+    memory-mapped copy-on-write and every tensor is a view of the mapping, so
+    only the pages that are actually used are read from disk, and processes
+    loading the same file share those pages through the page cache.
+
+    Arguments:
+      path (str): The safetensors file.
+      prefixes (list(str) or None): If set, only tensors whose names start
+        with one of these prefixes are loaded.
+
+    Returns:
+      (dict(str, torch.Tensor)): The loaded tensors, on CPU.
+    """
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_len
+    if prefixes is not None:
+        prefixes = tuple(prefixes)
+
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        if prefixes is not None and not name.startswith(prefixes):
+            continue
+        dtype = _DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if end == begin:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=(end - begin) // torch.empty((), dtype=dtype).element_size(),
+            offset=data_start + begin,
+        )
+        state_dict[name] = tensor.view(info["shape"])
+    return state_dict
@@ -0,0 +1,32 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def atomic_write(path: str) -> Iterator[str]:
+    """
+    Yields a temporary path in the directory of path to write to, and moves
+    the file written there to path when the block exits. Readers in other
+    threads or processes therefore never see a partially written file. If the
+    block raises, the temporary file is removed instead.
+
+    Arguments:
+      path (str): The file to write.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -10,7 +10,7 @@ from torch.nn import functional as F
 
 from typing import Tuple
 
-from ..modeling import Sam
+from ..modeling import SamPromptDecoder
 from .amg import calculate_stability_score
 
 
@@ -24,7 +24,7 @@ class SamOnnxModel(nn.Module):
 
     def __init__(
         self,
-        model: Sam,
+        model: SamPromptDecoder,
         return_single_mask: bool,
         use_stability_score: bool = False,
         return_extra_metrics: bool = False,
@@ -32,7 +32,7 @@ class SamOnnxModel(nn.Module):
         super().__init__()
         self.mask_decoder = model.mask_decoder
         self.model = model
-        self.img_size = model.image_encoder.img_size
+        self.img_size = model.img_size
         self.return_single_mask = return_single_mask
         self.use_stability_score = use_stability_score
         self.stability_score_offset = 1.0
@@ -30,6 +30,32 @@ class ResizeLongestSide:
         target_size = self.get_preprocess_shape(image.shape[0], image.shape[1], self.target_length)
         return np.array(resize(to_pil_image(image), target_size))
 
+    def apply_image_uint8_torch(self, image: np.ndarray) -> torch.Tensor:
+        """
+        Expects a numpy array with shape HxWxC in uint8 format. Returns the
+        resized image as a 1xCxHxW uint8 tensor in channels last memory
+        format. Resizes with torch's antialiased uint8 bilinear kernel instead
+        of a round trip through PIL, reading the image in place without a
+        copy. Matches apply_image up to the rounding of the kernel weights,
+        which use fewer fixed point bits than PIL's: a small fraction of pixel
+        values differ by 1 or 2, see scripts/verify_preprocessing.py.
+        """
+        target_size = self.get_preprocess_shape(image.shape[0], image.shape[1], self.target_length)
+        if any(stride < 0 for stride in image.strides):
+            # Negative strides, as from image[..., ::-1], cannot be viewed by torch
+            image = np.ascontiguousarray(image)
+        image_torch = torch.from_numpy(image).permute(2, 0, 1)[None, :, :, :]
+        if tuple(image_torch.shape[2:]) == target_size:
+            return image_torch
+        try:
+            return F.interpolate(
+                image_torch, target_size, mode="bilinear", align_corners=False, antialias=True
+            )
+        except (TypeError, RuntimeError):
+            # Older torch versions have no antialias argument (before 1.11), raising
+            # TypeError, or no uint8 kernel for antialiased resizing, raising RuntimeError
+            return torch.from_numpy(self.apply_image(image)).permute(2, 0, 1)[None, :, :, :]
+
     def apply_coords(self, coords: np.ndarray, original_size: Tuple[int, ...]) -> np.ndarray:
         """
         Expects a numpy array of length 2 in the final dimension. Requires the